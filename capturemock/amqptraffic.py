@@ -2,10 +2,16 @@
 import pika
 from capturemock import traffic, encodingutils
 from datetime import datetime
+from collections import deque
+import queue, threading, logging, time, atexit
 
 class AMQPConnector:
+    # Replaceable, e.g. by a stand-in for the broker in tests
+    connection_class = pika.BlockingConnection
     own_routing_key = "CaptureMock"
     terminate_body = b"terminate"
+    # Longest time to hold back acknowledgements when they're batched
+    ack_interval = 0.1
     def __init__(self, rcHandler=None, servAddr=None, connName=None):
         if rcHandler is not None:
             self.url = rcHandler.get("url", [ "amqp" ])
@@ -13,16 +19,30 @@ class AMQPConnector:
             self.exchange_type = rcHandler.get("exchange_type", [ "amqp" ])
             self.auto_delete = rcHandler.getboolean("auto_delete", [ "amqp" ], True)
             self.durable = rcHandler.getboolean("durable", [ "amqp" ], True)
+            # 0 means the broker sends as much as it likes, as before
+            self.prefetch_count = int(rcHandler.get("prefetch_count", [ "amqp" ], 0))
+            self.ack_batch_size = int(rcHandler.get("ack_batch_size", [ "amqp" ], 1))
         else:
             self.url, self.exchange = servAddr.rsplit("/", 1)
             self.exchange_type = None
             self.auto_delete = True
             self.durable = True
+            self.prefetch_count = 0
+            self.ack_batch_size = 1
+        if self.prefetch_count:
+            # The broker would stop sending before a bigger batch was complete
+            self.ack_batch_size = min(self.ack_batch_size, self.prefetch_count)
+        self.unacked_tag = None
+        self.unacked_count = 0
+        self.ack_timer = None
 
         params = pika.URLParameters(self.url)
         if connName:
             params.client_properties = { 'connection_name' : connName }
-        self.connection = pika.BlockingConnection(params)
+        self.connect(params)
+
+    def connect(self, params):
+        self.connection = self.connection_class(params)
         self.channel = self.connection.channel()
         if self.exchange_type:
             self.channel.exchange_declare(self.exchange, exchange_type=self.exchange_type, durable=self.durable, auto_delete=self.auto_delete)
@@ -34,6 +54,8 @@ class AMQPConnector:
         queue = self.get_queue_name()
         self.channel.queue_declare(queue, durable=True, auto_delete=True)
         self.channel.queue_bind(queue, self.exchange, routing_key="#")
+        if self.prefetch_count:
+            self.channel.basic_qos(prefetch_count=self.prefetch_count)
         self.channel.basic_consume(queue, on_message)
         try:
             self.channel.start_consuming()
@@ -41,6 +63,24 @@ class AMQPConnector:
             self.channel.stop_consuming()
         self.connection.close()
         
+    def acknowledge(self, delivery_tag):
+        self.unacked_tag = delivery_tag
+        self.unacked_count += 1
+        if self.unacked_count >= self.ack_batch_size:
+            self.send_ack()
+        elif self.ack_timer is None:
+            self.ack_timer = self.connection.call_later(self.ack_interval, self.send_ack)
+
+    def send_ack(self):
+        if self.ack_timer is not None:
+            self.connection.remove_timeout(self.ack_timer)
+            self.ack_timer = None
+        if self.unacked_tag is not None:
+            # Covers everything delivered up to this point
+            self.channel.basic_ack(delivery_tag=self.unacked_tag, multiple=self.unacked_count > 1)
+            self.unacked_tag = None
+            self.unacked_count = 0
+
     def replay(self, routing_key, body, msgType, headers):
         properties = pika.BasicProperties(headers=headers, type=msgType)
         self.channel.basic_publish(self.exchange, routing_key, body, properties=properties)
@@ -52,6 +92,7 @@ class AMQPConnector:
         return routing_key == self.own_routing_key and body == self.terminate_body
     
     def terminate(self):
+        self.send_ack()
         self.channel.stop_consuming()
         queue = self.get_queue_name()
         self.channel.queue_delete(queue)
@@ -62,6 +103,138 @@ class AMQPConnector:
 
 
 
+class AMQPReplayPublisher(AMQPConnector):
+    """ Publishes replayed messages from its own thread, with publisher confirms and a limit on unconfirmed messages """
+    connection_class = pika.SelectConnection
+    connect_timeout = 30
+    # How long to wait at exit for the broker to confirm what we've sent
+    flush_timeout = 30
+    def __init__(self, rcHandler, connName=None):
+        self.window = int(rcHandler.get("replay_window", [ "amqp" ], 0))
+        self.batch_size = int(rcHandler.get("replay_batch_size", [ "amqp" ], 100))
+        self.diag = logging.getLogger("AMQP Replay")
+        self.condition = threading.Condition()
+        self.pending = deque()
+        self.unconfirmed = deque()
+        self.publish_scheduled = False
+        self.delivery_tag = 0
+        self.confirmed, self.rejected, self.max_unconfirmed = 0, 0, 0
+        self.start_time = None
+        self.ready = threading.Event()
+        self.error = None
+        self.closed = False
+        AMQPConnector.__init__(self, rcHandler, connName=connName)
+        atexit.register(self.close)
+
+    def connect(self, params):
+        self.connection = self.connection_class(params, on_open_callback=self.on_connection_open,
+                                                on_open_error_callback=self.on_connection_failed,
+                                                on_close_callback=self.on_connection_closed)
+        self.channel = None
+        self.thread = threading.Thread(target=self.connection.ioloop.start, daemon=True)
+        self.thread.start()
+        if not self.ready.wait(self.connect_timeout):
+            raise TimeoutError("Timed out connecting to AMQP broker at " + self.url)
+        if self.error is not None:
+            raise self.error
+
+    def on_connection_open(self, connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_channel_open(self, channel):
+        self.channel = channel
+        if self.exchange_type:
+            channel.exchange_declare(self.exchange, exchange_type=self.exchange_type, durable=self.durable,
+                                     auto_delete=self.auto_delete, callback=self.on_exchange_declared)
+        else:
+            self.on_exchange_declared(None)
+
+    def on_exchange_declared(self, frame):
+        self.channel.confirm_delivery(self.on_confirm, callback=self.on_confirms_enabled)
+
+    def on_confirms_enabled(self, frame):
+        self.ready.set()
+
+    def on_connection_failed(self, connection, error):
+        self.error = error if isinstance(error, Exception) else ConnectionError(str(error))
+        self.on_connection_closed(connection, error)
+
+    def on_connection_closed(self, connection, reason):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.ready.set()
+        connection.ioloop.stop()
+
+    def replay(self, routing_key, body, msgType, headers):
+        properties = pika.BasicProperties(headers=headers, type=msgType)
+        with self.condition:
+            if self.start_time is None:
+                self.start_time = time.monotonic()
+            self.pending.append((routing_key, body, properties))
+            self.schedule_publish()
+
+    def schedule_publish(self):
+        # Only one wake-up of the publishing thread needed at a time
+        if not self.publish_scheduled and not self.closed:
+            self.publish_scheduled = True
+            self.connection.ioloop.add_callback_threadsafe(self.publish_pending)
+
+    def publish_pending(self):
+        with self.condition:
+            self.publish_scheduled = False
+            published = 0
+            while self.pending and len(self.unconfirmed) < self.window and published < self.batch_size:
+                routing_key, body, properties = self.pending.popleft()
+                self.channel.basic_publish(self.exchange, routing_key, body, properties=properties)
+                self.delivery_tag += 1
+                self.unconfirmed.append(self.delivery_tag)
+                published += 1
+            self.max_unconfirmed = max(self.max_unconfirmed, len(self.unconfirmed))
+            if self.pending and published == self.batch_size:
+                # Let confirms arrive before sending the next batch
+                self.schedule_publish()
+
+    def on_confirm(self, frame):
+        method = frame.method
+        with self.condition:
+            if method.multiple:
+                count = 0
+                while self.unconfirmed and self.unconfirmed[0] <= method.delivery_tag:
+                    self.unconfirmed.popleft()
+                    count += 1
+            else:
+                self.unconfirmed.remove(method.delivery_tag)
+                count = 1
+            if isinstance(method, pika.spec.Basic.Nack):
+                self.rejected += count
+                self.diag.warning("Broker rejected " + str(count) + " replayed message(s)")
+            else:
+                self.confirmed += count
+            self.condition.notify_all()
+        self.publish_pending()
+
+    def close(self):
+        atexit.unregister(self.close)
+        with self.condition:
+            if self.start_time is not None:
+                self.condition.wait_for(lambda: self.closed or not (self.pending or self.unconfirmed), self.flush_timeout)
+                self.report()
+            closed = self.closed
+        if not closed:
+            self.connection.ioloop.add_callback_threadsafe(self.connection.close)
+            self.thread.join(self.flush_timeout)
+
+    def report(self):
+        published = self.delivery_tag
+        duration = time.monotonic() - self.start_time
+        rate = published / duration if duration > 0 else 0
+        self.diag.info("Published " + str(published) + " replayed messages in " + "%.3f" % duration +
+                       " seconds (" + "%.1f" % rate + " per second): " + str(self.confirmed) + " confirmed, " +
+                       str(self.rejected) + " rejected, " + str(len(self.pending) + len(self.unconfirmed)) +
+                       " unconfirmed, at most " + str(self.max_unconfirmed) + " unconfirmed at once")
+
+
 class AMQPTrafficServer:
     @classmethod
     def createServer(cls, address, dispatcher):
@@ -71,19 +244,36 @@ class AMQPTrafficServer:
         self.count = 0
         self.dispatcher = dispatcher
         self.connector = AMQPConnector(self.dispatcher.rcHandler, connName="CaptureMock recorder")
+        # Recording happens in its own thread, so we keep up with the broker. Just one, to keep the order
+        self.messageQueue = queue.Queue()
+        self.recordThread = threading.Thread(target=self.recordMessages, daemon=True)
         
     def on_message(self, channel, method_frame, header_frame, body):
         self.count += 1
         routing_key = method_frame.routing_key
-        channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+        self.connector.acknowledge(method_frame.delivery_tag)
         if self.connector.isTermination(routing_key, body):
             self.connector.terminate()
         else:
+            self.messageQueue.put((self.count, routing_key, body, header_frame))
+
+    def recordMessages(self):
+        while True:
+            message = self.messageQueue.get()
+            if message is None:
+                return
+            count, routing_key, body, header_frame = message
             traffic = AMQPTraffic(rcHandler=self.dispatcher.rcHandler, routing_key=routing_key, body=body, props=header_frame)
-            self.dispatcher.process(traffic, self.count)
+            self.dispatcher.process(traffic, count)
         
     def run(self):
-        self.connector.record_from_queue(self.on_message)
+        self.recordThread.start()
+        try:
+            self.connector.record_from_queue(self.on_message)
+        finally:
+            # Everything received must be recorded before we stop
+            self.messageQueue.put(None)
+            self.recordThread.join()
 
     def getAddress(self):
         return self.connector.getAddress()
@@ -107,6 +297,7 @@ class AMQPTraffic(traffic.Traffic):
     typeId = "RMQ"
     headerStr = "\n--HEA:"
     connector = None
+    connectorLock = threading.Lock()
     def __init__(self, text=None, responseFile=None, rcHandler=None, routing_key=None, body=b"", origin=None, props=None):
         self.replay = routing_key is None
         self.origin = origin
@@ -156,14 +347,22 @@ class AMQPTraffic(traffic.Traffic):
     def forwardToDestination(self):
         # Replay and record handled entirely separately, unlike most other traffic, due to how MQ brokers work
         if self.replay:
-            if AMQPTraffic.connector is None:
-                AMQPTraffic.connector = AMQPConnector(self.rcHandler, connName="CaptureMock replay")
+            with AMQPTraffic.connectorLock:
+                if AMQPTraffic.connector is None:
+                    AMQPTraffic.connector = self.makeReplayConnector()
                 
             if self.origin:
                 self.headers["originfile"] = self.origin
             self.connector.replay(self.routing_key, self.body, self.msgType, self.headers)
         return []
     
+    def makeReplayConnector(self):
+        # With a window of unconfirmed messages, publishing doesn't wait for the broker
+        if int(self.rcHandler.get("replay_window", [ "amqp" ], 0)):
+            return AMQPReplayPublisher(self.rcHandler, connName="CaptureMock replay")
+        else:
+            return AMQPConnector(self.rcHandler, connName="CaptureMock replay")
+    
     def shouldBeRecorded(self, *args):
         return not self.replay and self.origin != "norecord" # never record these when replaying, must do it in one place
             
@@ -1,7 +1,7 @@
 
 from capturemock import clientservertraffic
 from datetime import datetime
-import sys, struct, socket
+import sys, struct, socket, selectors, time, re
 from pprint import pformat
 import logging
         
@@ -18,47 +18,97 @@ class BinaryServerSocketTraffic(clientservertraffic.ServerTraffic):
         return []
 
         
+class BufferedSocketReader:
+    """ Reads exact amounts from a socket, receiving as much as is available each time """
+    chunk_size = 65536
+    def __init__(self, sock):
+        self.socket = sock
+        self.buffer = bytearray()
+        self.pos = 0
+        self.chunk = bytearray(self.chunk_size)
+        self.chunkView = memoryview(self.chunk)
+
+    def available(self):
+        return len(self.buffer) - self.pos
+
+    def fill(self):
+        count = self.socket.recv_into(self.chunk)
+        if count == 0:
+            raise EOFError("connection closed")
+        if self.pos == len(self.buffer):
+            self.buffer.clear()
+            self.pos = 0
+        elif self.pos >= self.chunk_size:
+            del self.buffer[:self.pos]
+            self.pos = 0
+        self.buffer += self.chunkView[:count]
+
+    def peek(self, size):
+        while self.available() < size:
+            self.fill()
+        with memoryview(self.buffer) as view:
+            return bytes(view[self.pos:self.pos + size])
+
+    def read(self, size):
+        data = self.peek(size)
+        self.pos += size
+        return data
+
+    def read_until(self, terminator):
+        # offsets are relative to self.pos, which filling may move
+        searchOffset = 0
+        while True:
+            endPos = self.buffer.find(terminator, self.pos + searchOffset)
+            if endPos != -1:
+                return self.read(endPos + len(terminator) - self.pos)
+            searchOffset = max(0, self.available() - len(terminator) + 1)
+            self.fill()
+
+
 class BinaryTrafficConverter:
     header_timeout = 0.5
+    text_prefixes = (b"SUT_SERV", b"TERMINAT")
+    body_width = 200
     def __init__(self, rcHandler, sock, diag):
         self.rcHandler = rcHandler
         self.socket = sock
+        self.reader = None
         if sock:
             sock.settimeout(self.header_timeout)
-        self.headerConverter = BinaryMessageConverter(rcHandler, "tcp_header")
+            self.reader = BufferedSocketReader(sock)
+        self.headerConverter = BinaryMessageConverter.forSection(rcHandler, "tcp_header")
         self.text = None
         self.header = None
         self.header_fields = None
         self.body = None
         self.diag = diag
+        self.connectionId = 1
         
     def get_payload(self):
         return self.header + self.body
+
+    def has_buffered_header(self):
+        return self.reader.available() >= self.headerConverter.length
     
-    def read_text_until_newline(self, header):
-        rawBytes = header
-        while not rawBytes.endswith(b"\n"):
-            rawBytes += self.socket.recv(1)
-        return rawBytes.decode()
-        
     def read_header_or_text(self):
-        header = self.socket.recv(self.headerConverter.length)
-        if len(header) == 0:
-            raise TimeoutError("no data received")
-        # go to blocking mode once we have a header, need to make sure we read the rest
+        if self.reader.available() == 0:
+            self.reader.fill()
+        # go to blocking mode once we have some data, need to make sure we read the rest
         self.socket.settimeout(None)
         try:
-            if header.startswith(b"SUT_SERV") or header.startswith(b"TERMINAT"):
-                self.text = self.read_text_until_newline(header)            
+            # CaptureMock's own messages may be shorter than a header
+            prefix = self.reader.peek(min(len(self.text_prefixes[0]), self.headerConverter.length))
+            if prefix in self.text_prefixes:
+                self.text = self.reader.read_until(b"\n").decode()
                 self.diag.debug("Got message %s", self.text)
             else:
+                header = self.reader.read(self.headerConverter.length)
                 self.header = header
                 success, self.header_fields = self.headerConverter.parse(header)
                 self.diag.debug("Got header %s %s", header, self.header_fields)
                 if success:
                     length = self.get_body_length()
-                    if length:
-                        self.body = self.socket.recv(length)
+                    self.body = self.reader.read(length) if length else b""
                     self.diag.debug("Got body of size %s %s", length, self.body)
                 else:
                     self.diag.debug("Failed to parse incoming header %s", header)                    
@@ -87,13 +137,30 @@ class BinaryTrafficConverter:
             return self.body
         
     def parse_body(self):
-        bodyReader = BinaryMessageConverter(self.rcHandler, self.header_fields.get("type"))
+        bodyReader = BinaryMessageConverter.forSection(self.rcHandler, self.header_fields.get("type"))
         _, body_values = bodyReader.parse(self.get_body_to_parse())
         self.diag.debug("Got body %s", body_values)
-        self.text = self.headerConverter.getHeaderDescription(self.header_fields) + "\n" + pformat(body_values, sort_dicts=False, width=200)
+        self.text = self.describe(body_values)
         self.diag.debug("Recording %s", self.text)
         return self.text
     
+    def describe(self, body_values):
+        # pformat gives the plain repr for anything that fits on a line, but takes much longer to find that out
+        body_text = repr(body_values)
+        if len(body_text) > self.body_width:
+            body_text = pformat(body_values, sort_dicts=False, width=self.body_width)
+        return self.headerConverter.getHeaderDescription(self.get_header_fields_to_describe()) + "\n" + body_text
+
+    def get_header_fields_to_describe(self):
+        # Only mention the connection if there is more than one, so single connection recordings don't change
+        if self.connectionId > 1:
+            return dict(self.header_fields, connection=self.connectionId)
+        else:
+            return self.header_fields
+
+    def describeConnect(self):
+        return "connect" if self.connectionId == 1 else "connect " + str(self.connectionId)
+
     def read_and_parse(self):
         # If we can't read the header, ignore it and try the next one
         while not self.read_header_or_text():
@@ -104,7 +171,8 @@ class BinaryTrafficConverter:
     def convert_to_payload(self, text):
         header_line, remainder = text.split("\n", 1)
         self.header_fields = self.headerConverter.parseHeaderDescription(header_line)
-        bodyConv = BinaryMessageConverter(self.rcHandler, self.header_fields.get("type"))
+        self.header_fields.pop("connection", None)
+        bodyConv = BinaryMessageConverter.forSection(self.rcHandler, self.header_fields.get("type"))
         body_values = eval(remainder)
         payload = bodyConv.fields_to_payload(body_values)
         self.header_fields["length"] = len(payload)
@@ -114,9 +182,13 @@ class BinaryTrafficConverter:
         header_payload = self.headerConverter.fields_to_payload(self.header_fields)
         return header_payload + payload
     
-    def send_payload(self, text):
+    def send_payload(self, text, payloadCache=None):
         self.diag.debug("Payload text %s", text)
-        payload = self.convert_to_payload(text)
+        payload = payloadCache.get(text) if payloadCache is not None else None
+        if payload is None:
+            payload = self.convert_to_payload(text)
+            if payloadCache is not None:
+                payloadCache[text] = payload
         self.diag.debug("Sending payload %s", payload)
         self.socket.sendall(payload)
                 
@@ -131,6 +203,31 @@ class BinaryMessageConverter:
         self.enforce = self.readDictionary(rcHandler, "enforce", section)
         self.assume.update(self.enforce)
         self.length = struct.calcsize(self.formats[0]) if self.formats else 0
+        self.structs = self.compileFormats(self.formats)
+        # Which format to read with, by body length, and which to write with, by number of values
+        self.structsForLength = {}
+        self.structsForItemCount = {}
+        for compiled in self.structs:
+            itemCount = len(compiled.unpack(bytes(compiled.size)))
+            self.structsForItemCount.setdefault(itemCount, []).append(compiled)
+        self.enums = {}
+
+    @classmethod
+    def forSection(cls, rcHandler, rawSection):
+        # Converters are shared, and only recreated if the settings change
+        def createBinaryMessageConverter(section):
+            return cls(rcHandler, section)
+        return rcHandler.lookup(createBinaryMessageConverter, cls.toString(rawSection))
+
+    @staticmethod
+    def compileFormats(formats):
+        structs = []
+        for fmt in formats:
+            try:
+                structs.append(struct.Struct(fmt))
+            except struct.error:
+                pass
+        return structs
     
     def readDictionary(self, rcHandler, key, section):
         ret = {}
@@ -167,32 +264,36 @@ class BinaryMessageConverter:
         elif "parameters" in values:
             data += values["parameters"]
             
-        for fmt in self.formats:
+        for compiled in self.structsForItemCount.get(len(data), []):
             try:
-                return struct.pack(fmt, *data)
+                return compiled.pack(*data)
             except struct.error:
                 pass
             
     def get_parameter_key(self, values):
         return 
 
-    def toString(self, data):
+    @staticmethod
+    def toString(data):
         if isinstance(data, bytes):
             return data.decode()
         else:
             return str(data)
         
+    def getStructForLength(self, length):
+        if length not in self.structsForLength:
+            # The first format that fits, as struct.unpack_from ignores anything extra
+            self.structsForLength[length] = next((compiled for compiled in self.structs if compiled.size <= length), None)
+        return self.structsForLength[length]
+
     def parse(self, rawBytes):
-        data = None
-        for fmt in self.formats:
-            try:
-                data = struct.unpack_from(fmt, rawBytes)
-                break
-            except struct.error:
-                pass
-        if data is None:
+        compiled = self.getStructForLength(len(rawBytes))
+        if compiled is None:
             return False, { "unknown_format" : rawBytes.hex() }
         
+        return self.convert_values(compiled.unpack_from(rawBytes))
+
+    def convert_values(self, data):
         field_values = {}
         for i, field in enumerate(self.fields):
             if i < len(data):
@@ -207,6 +308,16 @@ class BinaryMessageConverter:
             if str(field_values.get(key)) != value:
                 ok = False
         return ok, field_values
+
+    def getEnums(self, field):
+        if field not in self.enums:
+            enum_list = self.rcHandler.getList(field, [ "enums"])
+            valuesToNames = { i + 1: name for i, name in enumerate(enum_list) }
+            namesToValues = {}
+            for value, name in valuesToNames.items():
+                namesToValues.setdefault(name, value)
+            self.enums[field] = enum_list, valuesToNames, namesToValues
+        return self.enums[field]
             
     def try_convert_enum(self, field, value):
         if not isinstance(value, int):
@@ -215,9 +326,11 @@ class BinaryMessageConverter:
         if field == "Time":
             return datetime.fromtimestamp(value).isoformat()
         
-        enum_list = self.rcHandler.getList(field, [ "enums"])
-        size = len(enum_list)
-        if size and value <= size:
+        enum_list, valuesToNames, _ = self.getEnums(field)
+        if value in valuesToNames:
+            return valuesToNames[value]
+        elif enum_list and value <= len(enum_list):
+            # zero and below count from the end, as they always have
             return enum_list[value - 1]
         else:
             return value
@@ -229,14 +342,154 @@ class BinaryMessageConverter:
         if field == "Time":
             return int(datetime.fromisoformat(value).timestamp())
         
-        enum_list = self.rcHandler.getList(field, [ "enums"])
-        if value in enum_list:
-            return enum_list.index(value) + 1
-        else:
-            return value
+        _, _, namesToValues = self.getEnums(field)
+        return namesToValues.get(value, value) if isinstance(value, str) else value
+
+class BinaryCaptureDecoder:
+    """ Decodes whole captured streams at once, giving the same text as BinaryTrafficConverter. Needs NumPy """
+    struct_codes = { "b": "i1", "B": "u1", "?": "u1", "h": "i2", "H": "u2", "i": "i4", "I": "u4", "l": "i4", "L": "u4",
+                     "q": "i8", "Q": "u8", "e": "f2", "f": "f4", "d": "f8" }
+    # NumPy can't reproduce the alignment of native formats, struct decodes those instead
+    byte_orders = { "<": "<", ">": ">", "!": ">", "=": "=" }
+    def __init__(self, rcHandler, diag=None):
+        import numpy
+        self.numpy = numpy
+        self.converter = BinaryTrafficConverter(rcHandler, None, diag or logging.getLogger("Binary TCP Traffic"))
+        self.dtypes = {}
+
+    def decode(self, rawBytes):
+        """ Returns the recorded text for each complete message in the stream """
+        messages = self.split_messages(rawBytes)
+        texts = []
+        for (header_fields, _, _), body_values in zip(messages, self.decode_bodies(rawBytes, messages)):
+            self.converter.header_fields = header_fields
+            texts.append(self.converter.describe(body_values))
+        return texts
+
+    def split_messages(self, rawBytes):
+        # Each header says where the next one is, so this part can't be vectorized
+        headerConverter = self.converter.headerConverter
+        headerStruct = headerConverter.getStructForLength(headerConverter.length)
+        messages = []
+        pos = 0
+        convertedHeaders = {}
+        while headerStruct and pos + headerConverter.length <= len(rawBytes):
+            header = headerStruct.unpack_from(rawBytes, pos)
+            if header not in convertedHeaders:
+                convertedHeaders[header] = headerConverter.convert_values(header)
+            ok, header_fields = convertedHeaders[header]
+            pos += headerConverter.length
+            if ok: # as when reading from a socket, the body of a rejected header is read as the next header
+                self.converter.header_fields = header_fields
+                bodyLength = self.converter.get_body_length() or 0
+                if pos + bodyLength > len(rawBytes):
+                    break
+                messages.append((header_fields, pos, min(bodyLength, header_fields.get("length", bodyLength))))
+                pos += bodyLength
+        return messages
+
+    def decode_bodies(self, rawBytes, messages):
+        groups = {}
+        for index, (header_fields, _, length) in enumerate(messages):
+            bodyConverter = BinaryMessageConverter.forSection(self.converter.rcHandler, header_fields.get("type"))
+            groups.setdefault((bodyConverter, length), []).append(index)
+
+        data = self.numpy.frombuffer(rawBytes, dtype=self.numpy.uint8)
+        allBodyValues = [ None ] * len(messages)
+        for (bodyConverter, length), indices in groups.items():
+            compiled = bodyConverter.getStructForLength(length)
+            dtype, columnTypes = self.get_dtype(compiled) if compiled else (None, None)
+            if dtype is None:
+                for index in indices:
+                    start = messages[index][1]
+                    allBodyValues[index] = bodyConverter.parse(rawBytes[start:start + length])[1]
+                continue
+
+            # Every body of the same type and length in one go
+            starts = self.numpy.array([ messages[index][1] for index in indices ])
+            bodies = data[starts[:, None] + self.numpy.arange(compiled.size)]
+            columns = list(zip(*bodies.view(dtype)[:, 0].tolist()))
+            columns = [ column if columnType is None else list(map(columnType, column)) for columnType, column in zip(columnTypes, columns) ]
+            for index, body_values in zip(indices, self.convert_columns(bodyConverter, columns, len(indices))):
+                allBodyValues[index] = body_values
+        return allBodyValues
+
+    def convert_columns(self, bodyConverter, columns, count):
+        # As BinaryMessageConverter.convert_values, converting each distinct value in a column once
+        fields = bodyConverter.fields[:len(columns)]
+        converted = [ self.convert_column(bodyConverter, field, column) for field, column in zip(fields, columns) ]
+        allValues = [ dict(zip(fields, row)) for row in zip(*converted) ] if fields else [ {} for _ in range(count) ]
+        paramStart = len(dict.fromkeys(fields))
+        if len(columns) > paramStart:
+            key = "additional_params" if "parameters" in fields else "parameters"
+            for values, parameters in zip(allValues, zip(*columns[paramStart:])):
+                values[key] = list(parameters)
+        return allValues
+
+    def convert_column(self, bodyConverter, field, column):
+        # Columns come from one NumPy type, so there is no mixing of e.g. 1 and True
+        if not isinstance(column[0], int) or (field != "Time" and not bodyConverter.getEnums(field)[0]):
+            return column
+        convertedValues = { value: bodyConverter.try_convert_enum(field, value) for value in set(column) }
+        return list(map(convertedValues.__getitem__, column))
+
+    def get_dtype(self, compiled):
+        if compiled.format not in self.dtypes:
+            self.dtypes[compiled.format] = self.make_dtype(compiled)
+        return self.dtypes[compiled.format]
+
+    def make_dtype(self, compiled):
+        fmt = compiled.format.replace(" ", "")
+        byteOrder = self.byte_orders.get(fmt[:1])
+        if byteOrder is None or compiled.size == 0:
+            return None, None
+        names, formats, offsets, columnTypes = [], [], [], []
+        offset = 0
+        for countText, code in re.findall(r"(\d*)(\D)", fmt[1:]):
+            count = int(countText) if countText else 1
+            if code == "x":
+                offset += count
+            elif code == "s" and count:
+                names.append("f" + str(len(names)))
+                formats.append(("u1", (count,)))
+                offsets.append(offset)
+                columnTypes.append(bytes)
+                offset += count
+            elif code in self.struct_codes:
+                numpyCode = self.struct_codes[code]
+                for _ in range(count):
+                    names.append("f" + str(len(names)))
+                    formats.append(byteOrder + numpyCode)
+                    offsets.append(offset)
+                    columnTypes.append(bool if code == "?" else None)
+                    offset += int(numpyCode[1])
+            else:
+                return None, None
+        if offset != compiled.size:
+            return None, None
+        dtype = self.numpy.dtype({ "names": names, "formats": formats, "offsets": offsets, "itemsize": compiled.size })
+        return dtype, columnTypes
+
+
+class TcpConnection:
+    """ A client of the server, and the connection to the real server made on its behalf """
+    def __init__(self, connectionId):
+        self.connectionId = connectionId
+        self.clientConverter = None
+        self.serverConverter = None
+        self.serverTrafficCache = []
+        # Server traffic is recorded with the last client message, so each connection reads coherently
+        self.openRequest = None
+
+    def setConverter(self, converter, attrName):
+        converter.connectionId = self.connectionId
+        setattr(self, attrName, converter)
+
 
 class TcpHeaderTrafficServer:
     connection_timeout = 0.2
+    # Order to handle sockets that are readable at the same time: server traffic first, as it may be a response
+    server_priority, client_priority, new_connection_priority, accept_priority = range(4)
     @classmethod
     def createServer(cls, address, dispatcher):
         return cls(address, dispatcher)
@@ -246,13 +499,35 @@ class TcpHeaderTrafficServer:
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.settimeout(self.connection_timeout)
         self.socket.bind((address, 0))
-        self.socket.listen(2)
+        self.socket.listen(socket.SOMAXCONN)
         self.diag = logging.getLogger("Binary TCP Traffic")
-        self.clientConverter = None
-        self.serverConverter = None
-        self.serverTrafficCache = []
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ, (self.accept_priority, self.acceptConnection, None))
+        self.connections = []
+        self.newConverters = {}
         self.terminate = False
         self.requestCount = 0
+        self.replayPayloads = {}
+        self.replayConnectionIds = {}
+        self.prepareReplayPayloads()
+
+    def prepareReplayPayloads(self):
+        # Convert the recorded responses once, replaying them is then just sending bytes
+        converter = BinaryTrafficConverter(self.dispatcher.rcHandler, None, self.diag)
+        for text in self.dispatcher.replayInfo.getResponseTexts(BinaryServerSocketTraffic.typeId):
+            if text not in self.replayPayloads:
+                try:
+                    self.replayConnectionIds[text] = self.parseConnectionId(text)
+                    self.replayPayloads[text] = converter.convert_to_payload(text)
+                except Exception as e:
+                    # Let it fail in the usual way if it's ever replayed
+                    self.diag.debug("Could not prepare payload for %s: %s", text, e)
+
+    @staticmethod
+    def parseConnectionId(text):
+        header_line = text.split("\n", 1)[0]
+        if " " in header_line:
+            return eval(header_line.split(" ", 1)[1]).get("connection")
 
     def getAddress(self):
         host, port = self.socket.getsockname()
@@ -265,96 +540,213 @@ class TcpHeaderTrafficServer:
             return connSocket
         except socket.timeout:
             pass
+
+    def findConnection(self, attrName):
+        # Clients and server connections are paired up in the order they appear
+        for connection in self.connections:
+            if getattr(connection, attrName) is None:
+                return connection
+        # Lowest free number, so a client that reconnects after the last one closed is still connection 1
+        connectionIds = set(connection.connectionId for connection in self.connections)
+        connectionId = 1
+        while connectionId in connectionIds:
+            connectionId += 1
+        connection = TcpConnection(connectionId)
+        self.connections.append(connection)
+        return connection
+
+    def needsServer(self):
+        if clientservertraffic.ClientSocketTraffic.destination is None:
+            return False
+        return len(self.connections) == 0 or any(connection.serverConverter is None for connection in self.connections)
         
     def tryConnectServer(self):
         dest = clientservertraffic.ClientSocketTraffic.destination
-        if dest is not None and self.serverConverter is None:
+        if self.needsServer():
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             try:
                 sock.connect(dest)
-                self.serverConverter = BinaryTrafficConverter(self.dispatcher.rcHandler, sock, self.diag)
-                self.diag.debug("Connected server %s", dest)
+                connection = self.findConnection("serverConverter")
+                connection.setConverter(BinaryTrafficConverter(self.dispatcher.rcHandler, sock, self.diag), "serverConverter")
+                self.selector.register(sock, selectors.EVENT_READ, (self.server_priority, self.readFromServer, connection))
+                self.diag.debug("Connected server %s for connection %s", dest, connection.connectionId)
             except OSError:
                 self.diag.debug("Connecting server failed %s", dest)
 
-    def handle_client_traffic(self, text, payload=None):
+    def handle_client_traffic(self, connection, text, payload=None):
+        self.completeRequest(connection)
         self.requestCount += 1
+        connection.openRequest = self.requestCount
         traffic = BinaryClientSocketTraffic(text, None, rcHandler=self.dispatcher.rcHandler)
-        responses = self.dispatcher.process(traffic, self.requestCount)
-        if self.serverConverter and payload is not None:
-            self.serverConverter.socket.sendall(payload)
-        elif self.clientConverter:
+        responses = self.dispatcher.process(traffic, self.requestCount, completeRequest=False)
+        if connection.serverConverter and payload is not None:
+            connection.serverConverter.socket.sendall(payload)
+        else:
             for response in responses:
-                self.clientConverter.send_payload(response.text)
+                # With several connections, responses are recorded in the order they arrived and may belong to another one
+                responseConnection = self.findResponseConnection(response.text, connection)
+                if responseConnection.clientConverter:
+                    responseConnection.clientConverter.send_payload(response.text, self.replayPayloads)
+
+    def findResponseConnection(self, text, connection):
+        if text not in self.replayConnectionIds:
+            self.replayConnectionIds[text] = self.parseConnectionId(text)
+        connectionId = self.replayConnectionIds[text]
+        # Recordings with one connection don't say, the response goes back where the request came from
+        if connectionId is not None:
+            for otherConnection in self.connections:
+                if otherConnection.connectionId == connectionId and otherConnection.clientConverter:
+                    return otherConnection
+        return connection
                 
-    def handle_server_traffic(self, text, payload):
-        if self.clientConverter:
-            self.handle_server_traffic_for_real(text, payload)
+    def handle_server_traffic(self, connection, text, payload):
+        if connection.clientConverter:
+            self.handle_server_traffic_for_real(connection, text, payload)
         else:
             self.diag.debug("Server traffic, no client")
-            self.serverTrafficCache.append((text, payload))
+            connection.serverTrafficCache.append((text, payload))
             
-    def handle_server_traffic_for_real(self, text, payload):
+    def handle_server_traffic_for_real(self, connection, text, payload):
         traffic = BinaryServerSocketTraffic(text, None, rcHandler=self.dispatcher.rcHandler)
-        self.requestCount += 1
-        self.dispatcher.process(traffic, self.requestCount)
-        self.clientConverter.socket.sendall(payload)
+        if connection.openRequest:
+            self.dispatcher.process(traffic, connection.openRequest, completeRequest=False)
+        else:
+            self.requestCount += 1
+            self.dispatcher.process(traffic, self.requestCount)
+        connection.clientConverter.socket.sendall(payload)
 
-    def try_client(self):
-        if self.clientConverter:
-            try:
-                text, payload = self.clientConverter.read_and_parse()
-                self.handle_client_traffic(text, payload)
-                return True
-            except OSError:
-                self.diag.debug("Read from client timed out")
-        return False
+    def completeRequest(self, connection):
+        if connection.openRequest:
+            self.dispatcher.recordFileHandler.requestComplete(connection.openRequest)
+            connection.openRequest = None
 
-    def try_server(self):
-        if not self.serverConverter:
-            self.tryConnectServer()
-        if self.serverConverter:
-            try:
-                text, payload = self.serverConverter.read_and_parse()
-                self.handle_server_traffic(text, payload)
-                return True
-            except OSError:
-                self.diag.debug("Read from server timed out")
-        return False
+    def readFromClient(self, connection):
+        try:
+            # The selector won't tell us about messages we've already received
+            while True:
+                text, payload = connection.clientConverter.read_and_parse()
+                self.handle_client_traffic(connection, text, payload)
+                if not connection.clientConverter.has_buffered_header():
+                    break
+        except EOFError:
+            self.diag.debug("Client closed connection %s", connection.connectionId)
+            self.closeConnection(connection)
+        except OSError:
+            self.diag.debug("Read from client timed out")
+
+    def closeConnection(self, connection):
+        self.selector.unregister(connection.clientConverter.socket)
+        connection.clientConverter.socket.close()
+        self.completeRequest(connection)
+        if connection.serverConverter:
+            # Let the real server know as well
+            if self.isRegistered(connection.serverConverter.socket):
+                self.selector.unregister(connection.serverConverter.socket)
+            connection.serverConverter.socket.close()
+        # Its number is free for the next client
+        self.connections.remove(connection)
+
+    def readFromServer(self, connection):
+        try:
+            while True:
+                text, payload = connection.serverConverter.read_and_parse()
+                self.handle_server_traffic(connection, text, payload)
+                if not connection.serverConverter.has_buffered_header():
+                    break
+        except EOFError:
+            self.diag.debug("Server closed connection %s", connection.connectionId)
+            self.selector.unregister(connection.serverConverter.socket)
+        except OSError:
+            self.diag.debug("Read from server timed out")
     
-    def handle_server_traffic_from_cache(self):
-        if len(self.serverTrafficCache):
-            for cacheText, cachePayload in self.serverTrafficCache:
-                self.handle_server_traffic_for_real(cacheText, cachePayload)
-            self.serverTrafficCache.clear()
+    def handle_server_traffic_from_cache(self, connection):
+        if len(connection.serverTrafficCache):
+            for cacheText, cachePayload in connection.serverTrafficCache:
+                self.handle_server_traffic_for_real(connection, cacheText, cachePayload)
+            connection.serverTrafficCache.clear()
+
+    def acceptConnection(self, *args):
+        connSocket = self.acceptSocket()
+        if connSocket:
+            converter = BinaryTrafficConverter(self.dispatcher.rcHandler, connSocket, self.diag)
+            # If nothing arrives in time, it's a client waiting for us to say something
+            self.newConverters[converter] = time.monotonic() + converter.header_timeout
+            self.selector.register(connSocket, selectors.EVENT_READ, (self.new_connection_priority, self.readNewConnection, converter))
+
+    def readNewConnection(self, converter):
+        del self.newConverters[converter]
+        self.selector.unregister(converter.socket)
+        try:
+            converter.read_header_or_text()
+        except EOFError:
+            converter.socket.close()
+            return
+        except socket.timeout:
+            self.setClientConnected(converter)
+            return
+        if converter.text: # complete message, i.e. special for CaptureMock
+            converter.socket.close()
+            self.dispatcher.processText(converter.text, None, self.requestCount)
+            self.diag.debug("Got message %s", converter.text)
+            self.tryConnectServer()
+        else:
+            connection = self.addClient(converter)
+            payload = converter.get_payload()
+            text = converter.parse_body()
+            self.handle_client_traffic(connection, text, payload)
+            if converter.has_buffered_header():
+                self.readFromClient(connection)
+
+    def addClient(self, converter):
+        connection = self.findConnection("clientConverter")
+        connection.setConverter(converter, "clientConverter")
+        self.selector.register(converter.socket, selectors.EVENT_READ, (self.client_priority, self.readFromClient, connection))
+        self.diag.debug("Client connection %s", connection.connectionId)
+        # Make sure it has a server to talk to before we forward anything
+        self.tryConnectServer()
+        return connection
+
+    def setClientConnected(self, converter):
+        connection = self.addClient(converter)
+        self.handle_client_traffic(connection, converter.describeConnect())
+        self.handle_server_traffic_from_cache(connection)
+        self.diag.debug("Timeout client read, set socket")
+
+    def checkSilentConnections(self):
+        now = time.monotonic()
+        for converter, deadline in list(self.newConverters.items()):
+            if deadline <= now:
+                del self.newConverters[converter]
+                self.selector.unregister(converter.socket)
+                self.setClientConnected(converter)
+
+    def getSelectTimeout(self):
+        if self.newConverters:
+            return max(0, min(self.newConverters.values()) - time.monotonic())
+        elif self.needsServer():
+            return self.connection_timeout # retry connecting the server
 
     def run(self):
         while not self.terminate:
-            while self.try_server():
-                pass
-            
-            if self.try_client():
-                continue
-            connSocket = self.acceptSocket()
-            if connSocket:
-                converter = BinaryTrafficConverter(self.dispatcher.rcHandler, connSocket, self.diag)
-                try:
-                    converter.read_header_or_text()
-                except socket.timeout:
-                    self.clientConverter = converter
-                    self.handle_client_traffic("connect")
-                    self.handle_server_traffic_from_cache()
-                    self.diag.debug("Timeout client read, set socket")
-                    continue
-                if converter.text: # complete message, i.e. special for CaptureMock
-                    self.dispatcher.processText(converter.text, None, self.requestCount)
-                    self.diag.debug("Got message %s", converter.text)
-                    self.tryConnectServer()
-                else:
-                    self.clientConverter = converter
-                    payload = self.clientConverter.get_payload()
-                    text = self.clientConverter.parse_body()
-                    self.handle_client_traffic(text, payload)
+            self.tryConnectServer()
+            events = self.selector.select(self.getSelectTimeout())
+            for key, _ in sorted(events, key=lambda event: event[0].data[0]):
+                if self.terminate:
+                    break
+                # Earlier handlers may have closed this socket
+                if self.isRegistered(key.fileobj, key):
+                    _, handler, target = key.data
+                    handler(target)
+            self.checkSilentConnections()
+        for connection in self.connections:
+            self.completeRequest(connection)
+
+    def isRegistered(self, sock, key=None):
+        try:
+            currKey = self.selector.get_key(sock)
+            return key is None or currKey is key
+        except (KeyError, ValueError):
+            return False
                 
     def shutdown(self):
         self.terminate = True
@@ -431,6 +823,11 @@ if __name__ == "__main__":
             ret = self.rawBytes[:count]
             self.rawBytes = self.rawBytes[count:]
             return ret
+
+        def recv_into(self, buffer):
+            ret = self.recv(len(buffer))
+            buffer[:len(ret)] = ret
+            return len(ret)
         
         def settimeout(self, *args):
             pass
@@ -241,6 +241,7 @@ class InterceptHandler:
         from . import replayinfo
         self.replayInfo = replayinfo.ReplayInfo(mode, replayFile, self.rcHandler)
         self.recordFile = recordFile
+        self.trafficHandler = None
         self.allAttrNames = self.findAttributeNames(mode, pythonAttrs)
 
     def findAttributeNames(self, mode, pythonAttrs):
@@ -275,6 +276,7 @@ class InterceptHandler:
         from .pythontraffic import PythonTrafficHandler
         trafficHandler = PythonTrafficHandler(self.replayInfo, self.recordFile, self.rcHandler,
                                               callStackChecker, self.allAttrNames)
+        self.trafficHandler = trafficHandler
         if len(fullIntercepts):
             import_handler = ImportHandler(fullIntercepts, callStackChecker, trafficHandler)
             if import_handler not in sys.meta_path:
@@ -333,7 +335,12 @@ class InterceptHandler:
         setattr(realObj, attrName, proxy)
         self.attributesIntercepted.append((realObj, attrName, origValue))
 
+    def closeRecordFile(self):
+        if self.trafficHandler:
+            self.trafficHandler.recordFileHandler.close()
+
     def resetIntercepts(self):
+        self.closeRecordFile()
         for item in sys.meta_path:
             if isinstance(item, ImportHandler):
                 item.reset()
@@ -1,9 +1,9 @@
 """ Traffic classes for capturing client-server interaction """
 
-import socket, sys, os
+import socket, sys, os, re, time, threading, http.client
+from collections import deque
+from urllib.parse import urlsplit, urljoin
 from capturemock import traffic, encodingutils
-from urllib.request import urlopen, Request
-from urllib.error import HTTPError, URLError
 from capturemock.fileedittraffic import FileEditTraffic
 
 try:
@@ -104,14 +104,72 @@ class XmlRpcClientTraffic(ClientSocketTraffic):
         return "" # not a response in the xmlrpc sense...
 
 
+class HTTPConnectionPool:
+    """ Idle connections to one real server, so we don't connect again for every request we forward """
+    def __init__(self, scheme, host, port, maxSize, idleTimeout, diag):
+        self.connectionClass = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        self.host = host
+        self.port = port
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self.diag = diag
+        self.idle = deque()
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def getDescription(self):
+        return self.host + ":" + str(self.port)
+
+    def get(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.idle:
+                connection, lastUsed = self.idle.pop()
+                if now - lastUsed < self.idleTimeout:
+                    self.reused += 1
+                    self.logStatistics("Reusing")
+                    return connection, True
+                connection.close()
+        return self.newConnection(), False
+
+    def newConnection(self):
+        with self.lock:
+            self.opened += 1
+            self.logStatistics("Opening")
+        return self.connectionClass(self.host, self.port)
+
+    def put(self, connection):
+        with self.lock:
+            if len(self.idle) < self.maxSize:
+                self.idle.append((connection, time.monotonic()))
+                return
+        connection.close()
+
+    def logStatistics(self, action):
+        if self.diag:
+            self.diag.debug(action + " connection to " + self.getDescription() + ": " + str(self.opened) + " opened, " +
+                            str(self.reused) + " reused, " + str(len(self.idle)) + " idle")
+
+
 class HTTPClientTraffic(ClientSocketTraffic):
     headerStr = "--HEA:"
     fileContentsStr = "<File Contents for %s>"
     defaultIgnoreHeaders = [ "Content-Length", "Host", "User-Agent", "Connection", "Referer", "Date"] # provided automatically, or not usable when recorded
     defaultValues = {"Content-Type": "application/x-www-form-urlencoded", "Accept-Encoding": "identity"}
     repeatCache = {}
+    responseCache = {}
+    connectionPools = {}
+    poolLock = threading.Lock()
+    # Connection-related headers are for the connection to us, not the one to the real server
+    hopByHopHeaders = [ "connection", "keep-alive", "transfer-encoding", "content-length" ]
+    redirectCodes = [ 301, 302, 303, 307, 308 ]
+    maxRedirects = 10
+    streamChunkSize = 65536
+    rangeRegex = re.compile(r"bytes=(\d*)-(\d*)$")
     def __init__(self, text=None, responseFile=None, rcHandler=None, method="GET", path="/", headers={}, handler=None, **kw):
         self.handler = handler
+        self.rcHandler = rcHandler
         self.ignoreHeaders = self.defaultIgnoreHeaders + rcHandler.getList("ignore_http_headers", [ "general" ])
         if responseFile is not None: # record
             self.method = method
@@ -141,6 +199,7 @@ class HTTPClientTraffic(ClientSocketTraffic):
                 textStr = ""
                 self.payload = None
         self.checkRepeats = rcHandler.getboolean("check_repeated_calls", [ self.method ], True)
+        self.responseStreamed = False
         
     def hasRepeatsInReplay(self):
         return self.checkRepeats
@@ -168,7 +227,8 @@ class HTTPClientTraffic(ClientSocketTraffic):
     def writeEditFile(self, filename, contents):
         editdir = FileEditTraffic.recordFileEditDir
         path = os.path.join(editdir, filename)
-        if os.path.isfile(path):
+        # Only read the old one if it could be the same
+        if os.path.isfile(path) and os.path.getsize(path) == len(contents):
             oldContents = open(path, "rb").read()
             if oldContents == contents:
                 return filename
@@ -186,36 +246,67 @@ class HTTPClientTraffic(ClientSocketTraffic):
         boundaryText = self.parseVariable(contentType, "boundary")
         if boundaryText:
             return b"--" + boundaryText.encode()
-        
-    def getFileEditContents(self, filename):
+
+    def findFileParts(self, payload, boundary):
+        # Where the contents of each uploaded file start and end, and its name
+        linesep = b"\r\n"
+        delimiter = linesep + boundary
+        pos = payload.find(boundary)
+        while pos != -1:
+            headerStart = pos + len(boundary)
+            headerEnd = payload.find(linesep + linesep, headerStart)
+            if headerEnd == -1:
+                return
+            start = headerEnd + 2 * len(linesep)
+            end = payload.find(delimiter, start)
+            if end == -1:
+                return
+            for line in payload[headerStart:headerEnd].split(linesep):
+                textLine = encodingutils.decodeBytes(line)
+                if textLine.startswith("Content-Disposition: form-data;"):
+                    filename = self.parseVariable(textLine, "filename")
+                    if filename:
+                        yield start, end, filename
+            pos = end + len(linesep)
+
+    def getFileEditPath(self, filename):
         if FileEditTraffic.replayFileEditDir:
             filepath = os.path.join(FileEditTraffic.replayFileEditDir, filename)
             if os.path.isfile(filepath):
-                return open(filepath, "rb").read()
+                return filepath
+
+    def getFileEditContents(self, filename):
+        filepath = self.getFileEditPath(filename)
+        if filepath:
+            return open(filepath, "rb").read()
         
     def tryReplaceFileContents(self):
         boundary = self.getBoundary()
         if boundary:
             linesep = b"\r\n"
             prefix, postfix = self.fileContentsStr.encode().split(b"%s")
-            newPayload = b""
-            currPayload = self.payload
-            start = currPayload.find(prefix)
+            payloadView = memoryview(self.payload)
+            parts = []
+            pos = 0
+            start = self.payload.find(prefix)
             while start != -1:
-                end = currPayload.find(linesep, start)
-                filenameBytes = currPayload[start + len(prefix):end - len(postfix)]
+                end = self.payload.find(linesep, start)
+                if end == -1:
+                    end = len(self.payload)
+                filenameBytes = self.payload[start + len(prefix):end - len(postfix)]
                 filename = encodingutils.decodeBytes(filenameBytes)
                 contents = self.getFileEditContents(filename)
-                if contents:
-                    newPayload += currPayload[:start]
-                    newPayload += contents
-                    currPayload = currPayload[end:]
+                if contents is not None:
+                    parts.append(payloadView[pos:start])
+                    parts.append(contents)
+                    pos = end
                 else:
                     print("ERROR: Cannot find file named", repr(filename), "when replaying!", file=sys.stderr)
                     break
-                start = currPayload.find(prefix)
-            if newPayload:
-                self.payload = newPayload + currPayload
+                start = self.payload.find(prefix, pos)
+            if parts:
+                parts.append(payloadView[pos:])
+                self.payload = b"".join(parts)
          
     def getAttachmentFileName(self, headers):
         disposition = dict(headers).get("Content-Disposition", "")
@@ -223,16 +314,23 @@ class HTTPClientTraffic(ClientSocketTraffic):
             return self.parseVariable(disposition, "filename")
                 
     def decodeResponsePayload(self, payload, headers):
-        attachmentFn = self.getAttachmentFileName(headers)
-        if attachmentFn:
-            fnUsed = self.writeEditFile(attachmentFn, payload)
-            return self.fileContentsStr % fnUsed + self.getHeaderText(headers), payload
+        if self.getAttachmentFileName(headers):
+            return self.decodeResponseText(payload, headers), payload
         else:
             body = encodingutils.decodeBytes(payload)
             body = self.applyAlterations(body)
             text = body + self.getHeaderText(headers)
             newPayload = encodingutils.encodeString(body)
             return text, newPayload
+
+    def decodeResponseText(self, payload, headers):
+        # Alterations aren't applied: attachments are kept as they are, and we don't stream if there are any
+        attachmentFn = self.getAttachmentFileName(headers)
+        if attachmentFn:
+            fnUsed = self.writeEditFile(attachmentFn, payload)
+            return self.fileContentsStr % fnUsed + self.getHeaderText(headers)
+        else:
+            return encodingutils.decodeBytes(payload) + self.getHeaderText(headers)
                 
     def decodePayload(self, payload):
         if payload is None:
@@ -241,27 +339,19 @@ class HTTPClientTraffic(ClientSocketTraffic):
         if boundary is None:
             return encodingutils.decodeBytes(payload)
         
-        linesep = b"\r\n"
-        lines = []
-        currFileName, currFileWritten, fileContents = None, False, b""
-        for line in payload.split(linesep):
-            hitBoundary = currFileName and line.startswith(boundary)
-            if line and currFileName and not hitBoundary and not line.startswith(b"Content-"):
-                if currFileWritten:
-                    fileContents += linesep
-                fileContents += line
-                currFileWritten = True
-            else:
-                textLine = encodingutils.decodeBytes(line)
-                if hitBoundary:
-                    fileNameUsed = self.writeEditFile(currFileName, fileContents)
-                    lines.append(self.fileContentsStr % fileNameUsed)
-                    currFileName, currFileWritten, fileContents = None, False, b""
-                elif textLine.startswith("Content-Disposition: form-data;"):
-                    currFileName = self.parseVariable(textLine, "filename")
-            
-                lines.append(textLine)
-        return "\n".join(lines)
+        # File contents are written out from the payload as they are, without copying them
+        payloadView = memoryview(payload)
+        textParts = []
+        pos = 0
+        for start, end, filename in self.findFileParts(payload, boundary):
+            textParts.append(self.decodeLines(payload[pos:start]))
+            textParts.append(self.fileContentsStr % self.writeEditFile(filename, payloadView[start:end]))
+            pos = end
+        textParts.append(self.decodeLines(payload[pos:]))
+        return "".join(textParts)
+
+    def decodeLines(self, data):
+        return "\n".join(encodingutils.decodeBytes(line) for line in data.split(b"\r\n"))
 
     def extractHeaders(self, textStr, headers):
         if HTTPClientTraffic.headerStr in textStr:
@@ -290,37 +380,180 @@ class HTTPClientTraffic(ClientSocketTraffic):
         
     def forwardToServer(self):
         try:
-            request = Request(self.destination + self.path, data=self.payload, headers=self.headers, method=self.method)
-            response = urlopen(request)
-            payload = response.read()
-            headers = response.getheaders()
-            text, body = self.decodeResponsePayload(payload, headers)
-            return [ HTTPServerTraffic(response.status, text, body, headers, self.responseFile, handler=self.handler) ]
-        except HTTPError as e:
-            payload = e.read()
-            headers = e.getheaders()
+            status, payload, headers = self.sendRequest(self.method, self.destination + self.path, self.payload)
+            if self.responseStreamed:
+                # The client has it already, we only need it for the record
+                text = self.decodeResponseText(payload, headers)
+                return [ HTTPServerTraffic(status, text, payload, headers, None, handler=None) ]
             text, body = self.decodeResponsePayload(payload, headers)
-            return [ HTTPServerTraffic(e.code, text, body, headers, self.responseFile, handler=self.handler) ]
-        except URLError as e:
+            return [ HTTPServerTraffic(status, text, body, headers, self.responseFile, handler=self.handler) ]
+        except (OSError, http.client.HTTPException) as e:
             sys.stderr.write("Failed to forward http traffic to server " + self.destination + " : " + str(e) + "\n")
+            if self.responseStreamed:
+                # Part of a response went to the client, the connection can't be used for anything else
+                self.handler.close_connection = True
             return []
+
+    @classmethod
+    def getConnectionPool(cls, scheme, host, port, rcHandler):
+        key = scheme, host, port
+        with cls.poolLock:
+            pool = cls.connectionPools.get(key)
+            if pool is None:
+                maxSize = int(rcHandler.get("http_connection_pool_size", [ "general" ], 10))
+                idleTimeout = float(rcHandler.get("http_connection_idle_timeout", [ "general" ], 30))
+                pool = HTTPConnectionPool(scheme, host, port, maxSize, idleTimeout, rcHandler.diag)
+                cls.connectionPools[key] = pool
+            return pool
+
+    def getRequestHeaders(self, payload):
+        headers = {}
+        for header, value in self.headers.items():
+            if header.lower() not in self.hopByHopHeaders:
+                headers[header] = value
+        if payload is not None and not any((header.lower() == "content-type" for header in headers)):
+            headers["Content-Type"] = self.defaultValues["Content-Type"] # as urllib would add
+        return headers
+
+    def sendRequest(self, method, url, payload):
+        headers = self.getRequestHeaders(payload)
+        # Follow redirects in the same cases urllib does
+        for _ in range(self.maxRedirects + 1):
+            status, responsePayload, responseHeaders = self.sendOneRequest(method, url, payload, headers)
+            location = dict(responseHeaders).get("Location")
+            if status not in self.redirectCodes or location is None:
+                break
+            if method in [ "GET", "HEAD" ]:
+                url = urljoin(url, location)
+            elif method == "POST" and status in [ 301, 302, 303 ]:
+                url = urljoin(url, location)
+                method, payload = "GET", None
+                headers = { header: value for header, value in headers.items() if header.lower() != "content-type" }
+            else:
+                break
+        return status, responsePayload, responseHeaders
+
+    def sendOneRequest(self, method, url, payload, headers):
+        urlParts = urlsplit(url)
+        target = urlParts.path or "/"
+        if urlParts.query:
+            target += "?" + urlParts.query
+        port = urlParts.port or (443 if urlParts.scheme == "https" else 80)
+        pool = self.getConnectionPool(urlParts.scheme, urlParts.hostname, port, self.rcHandler)
+        connection, reused = pool.get()
+        try:
+            response, responsePayload = self.getResponse(connection, method, target, payload, headers)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            if not reused or self.responseStreamed:
+                raise
+            # The server closed it while it was idle, try again with a new one
+            connection = pool.newConnection()
+            response, responsePayload = self.getResponse(connection, method, target, payload, headers)
+        if response.will_close:
+            connection.close()
+        else:
+            pool.put(connection)
+        return response.status, responsePayload, response.getheaders()
+
+    def getResponse(self, connection, method, target, payload, headers):
+        try:
+            connection.request(method, target, body=payload, headers=headers)
+            response = connection.getresponse()
+            if self.canStream(response):
+                return response, self.streamResponse(response)
+            else:
+                return response, response.read()
+        except:
+            connection.close()
+            raise
+
+    def canStream(self, response):
+        # Only if we know the length, and the client would get exactly what the server sent anyway
+        return self.handler is not None and response.length is not None and not self.alterations and not self.idMapping and \
+            (response.status not in self.redirectCodes or response.getheader("Location") is None) and \
+            self.rcHandler.getboolean("http_stream_responses", [ "general" ], False)
+
+    def streamResponse(self, response):
+        self.responseStreamed = True
+        headerBlock = HTTPServerTraffic.makeHeaderBlock(response.getheaders(), response.length)
+        clientConnected = self.writeToClient(self.handler.make_response_head(response.status, headerBlock))
+        chunks = []
+        while response.length:
+            chunk = response.read1(self.streamChunkSize)
+            if not chunk:
+                raise http.client.IncompleteRead(b"".join(chunks), response.length)
+            chunks.append(chunk)
+            if clientConnected:
+                # Keep reading if the client goes away, we still record what the server sent
+                clientConnected = self.writeToClient(chunk)
+        # read1 doesn't mark it finished, and the connection can't be reused until it is
+        response.close()
+        return b"".join(chunks)
+
+    def writeToClient(self, data):
+        try:
+            self.responseFile.write(data)
+            self.responseFile.drain()
+            return True
+        except ConnectionError:
+            return False
         
     def makeResponseTraffic(self, rawText, responseClass, rcHandler):
         if responseClass is HTTPServerTraffic:
-            status, text = rawText.split(" ", 1)
-            text = self.applyAlterations(text)
-            headerDict = {}
-            bodyText = self.extractHeaders(text, headerDict)
-            body = encodingutils.encodeString(bodyText)
-            attachmentFn = self.getAttachmentFileName(headerDict)
-            if attachmentFn:
-                replaceStr = (self.fileContentsStr % attachmentFn).encode()
-                body = body.replace(replaceStr, self.getFileEditContents(attachmentFn))
-            headers = list(headerDict.items())
-            return responseClass(int(status), text, body, headers, self.responseFile, self.handler)
+            # The same text always gives the same response, until the alterations or ID mappings change
+            idCount = len(self.idMapping) if self.idMapping is not None else 0
+            cached = self.responseCache.get(rawText)
+            if cached is None or cached[0] is not self.alterations or cached[1] != idCount:
+                cached = self.alterations, idCount, self.buildResponse(rawText)
+                self.responseCache[rawText] = cached
+            status, text, body, headers, headerBlock = cached[2]
+            byteRange = self.getRequestedRange(status, len(body))
+            if byteRange:
+                status, body, headerBlock = self.makePartialResponse(byteRange, body, headers)
+            return responseClass(status, text, body, headers, self.responseFile, self.handler, headerBlock)
         else:
             return super(HTTPClientTraffic, self).makeResponseTraffic(rawText, responseClass, rcHandler)
 
+    def buildResponse(self, rawText):
+        status, text = rawText.split(" ", 1)
+        text = self.applyAlterations(text)
+        headerDict = {}
+        bodyText = self.extractHeaders(text, headerDict)
+        body = encodingutils.encodeString(bodyText)
+        attachmentFn = self.getAttachmentFileName(headerDict)
+        if attachmentFn:
+            replaceStr = (self.fileContentsStr % attachmentFn).encode()
+            filepath = self.getFileEditPath(attachmentFn)
+            if body == replaceStr and filepath:
+                # The usual case, as we record it. Don't read it, it's sent straight from the file
+                body = HTTPFileBody(filepath)
+            else:
+                body = body.replace(replaceStr, self.getFileEditContents(attachmentFn))
+        headers = list(headerDict.items())
+        return int(status), text, body, headers, HTTPServerTraffic.makeHeaderBlock(headers, len(body))
+
+    def getRequestedRange(self, status, length):
+        # Single byte ranges of complete responses only. Otherwise we send it all, which clients must accept
+        rangeHeader = self.headers.get("Range") if self.handler is not None and status == 200 else None
+        match = self.rangeRegex.match(rangeHeader.strip()) if rangeHeader else None
+        if match is None or not any(match.groups()):
+            return
+        first, last = match.groups()
+        if not first:
+            return max(length - int(last), 0), length
+        elif not last or int(first) <= int(last):
+            return int(first), min(int(last) + 1, length) if last else length
+
+    def makePartialResponse(self, byteRange, body, headers):
+        start, end = byteRange
+        length = len(body)
+        if start >= end:
+            rangeHeaders = [ ("Content-Range", "bytes */" + str(length)) ]
+            return 416, b"", HTTPServerTraffic.makeHeaderBlock(rangeHeaders, 0)
+        else:
+            rangeHeaders = headers + [ ("Content-Range", "bytes %d-%d/%d" % (start, end - 1, length)) ]
+            return 206, body[start:end], HTTPServerTraffic.makeHeaderBlock(rangeHeaders, end - start)
+
 
 class ServerTraffic(traffic.Traffic):
     typeId = "SRV"
@@ -347,26 +580,44 @@ class XmlRpcServerTraffic(ServerTraffic):
             return self.responseObject
         
 class HTTPServerTraffic(ServerTraffic):
-    def __init__(self, status, text, body, headers, responseFile, handler):
+    framingHeaders = [ "content-length", "transfer-encoding", "connection", "keep-alive" ]
+    def __init__(self, status, text, body, headers, responseFile, handler, headerBlock=None):
         self.body = body
         ServerTraffic.__init__(self, str(status) + " " + text, responseFile)
         self.status = status
         self.headers = headers
         self.handler = handler
+        self.headerBlock = headerBlock
+
+    @classmethod
+    def makeHeaderBlock(cls, headers, bodyLength):
+        lines = []
+        for hdr, value in headers:
+            # We always send the body in one go, so work out its length ourselves rather than using any recorded framing
+            # Connection-related headers are for the connection to the real server, not this one
+            if hdr.lower() not in cls.framingHeaders:
+                lines.append("%s: %s\r\n" % (hdr, value))
+        lines.append("Content-Length: " + str(bodyLength) + "\r\n")
+        lines.append("Access-Control-Allow-Origin: *\r\n")
+        lines.append("Access-Control-Expose-Headers: *\r\n")
+        return "".join(lines).encode("latin-1", "strict")
     
     def forwardToDestination(self):
         if self.handler:
             # don't include server and date, chances are we already have them
-            self.handler.send_response_only(self.status)
-            for hdr, value in self.headers:
-                # Might need to handle chunked transfer, for now, just ignore it and return it as one
-                if hdr.lower() != "transfer-encoding" or value.lower() != "chunked":
-                    self.handler.send_header(hdr, value)
-            self.handler.send_header('Access-Control-Allow-Origin', '*')
-            self.handler.send_header('Access-Control-Expose-Headers', '*')
-            self.handler.end_headers()
-        self.write(self.body)
-        # Don't close the file, the HTTP server mechanism does that for us
+            headerBlock = self.headerBlock or self.makeHeaderBlock(self.headers, len(self.body))
+            head = self.handler.make_response_head(self.status, headerBlock)
+            if isinstance(self.body, HTTPFileBody):
+                self.write(head)
+                self.sendFile(self.body)
+            else:
+                # One write for the whole response
+                self.write(head + self.body)
+        elif isinstance(self.body, HTTPFileBody):
+            self.sendFile(self.body)
+        else:
+            self.write(self.body)
+        # Don't close the connection, the HTTP server decides whether it can be used again
         return []
     
     def write(self, message):
@@ -374,13 +625,35 @@ class HTTPServerTraffic(ServerTraffic):
             try:
                 self.responseFile.write(message)
                 self.responseFile.flush()
-                self.handler.request.shutdown(socket.SHUT_WR)
-                self.handler.request.close()
             except ConnectionError:
                 # The service that sent the original request is no longer listening for answers
                 # This is not necessarily a problem - we don't want to raise exceptions here
                 pass
 
+    def sendFile(self, body):
+        if self.responseFile:
+            try:
+                with open(body.path, "rb") as f:
+                    self.responseFile.sendfile(f, body.offset, body.size)
+            except ConnectionError:
+                pass # as for write, above
+
+
+class HTTPFileBody:
+    """ Replayed body that stays in the replay edit directory until it's sent """
+    def __init__(self, path, offset=0, size=None):
+        self.path = path
+        self.offset = offset
+        self.size = os.path.getsize(path) if size is None else size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, part):
+        # Byte ranges only, for partial responses
+        start, stop, _ = part.indices(self.size)
+        return HTTPFileBody(self.path, self.offset + start, max(stop - start, 0))
+
 class ServerStateTraffic(ServerTraffic):
     def __init__(self, inText, dest, responseFile, rcHandler):
         ServerTraffic.__init__(self, inText, responseFile, rcHandler)
@@ -5,7 +5,8 @@ try:
 except ImportError: # python3
     from ConfigParser import ConfigParser
     
-import os, sys, logging.config
+import os, sys, re, threading, logging.config
+from .traffic import AlterationSet
 
 REPLAY = 0
 RECORD = 1
@@ -19,6 +20,14 @@ class RcFileHandler:
         self.parser = ConfigParser(strict=False)
         self.diag = None
         self.address = None
+        self.alterationCache = {}
+        # Settings looked up so far, keyed on method, setting and sections, until the settings change
+        self.lookupCache = {}
+        self.cacheGeneration = 0
+        self.lookups = 0
+        self.lookupHits = 0
+        self.statisticsLock = threading.Lock()
+        self.idMapping = None
         if rcFiles:
             for rcFile in rcFiles:
                 if not os.path.isfile(rcFile):
@@ -29,6 +38,18 @@ class RcFileHandler:
 
     def addFile(self, rcFile):
         self.parser.read(rcFile)
+        self.clearCaches()
+
+    def clearCaches(self):
+        self.cacheGeneration += 1
+        self.alterationCache.clear()
+        self.lookupCache.clear()
+
+    def getLookupStatistics(self):
+        with self.statisticsLock:
+            lookups, lookupHits = self.lookups, self.lookupHits
+        hitRate = 100.0 * lookupHits / lookups if lookups else 0.0
+        return str(lookups) + " settings lookups, " + "%.1f" % hitRate + "% from cache"
 
     def getPersonalPath(self, fileName):
         return os.path.join(os.path.expanduser("~/.capturemock"), fileName)
@@ -37,7 +58,7 @@ class RcFileHandler:
         return self.getList("intercepts", [ section ])
 
     def get(self, *args):
-        return self._get(self.parser.get, *args)
+        return self._get("get", *args)
     
     def getWithAddress(self, *args):
         rawValue = self.get(*args)
@@ -47,23 +68,66 @@ class RcFileHandler:
         return rawValue.replace("${CAPTUREMOCK_SERVER}", self.address).replace("${CAPTUREMOCK_PORT}", port)
 
     def getboolean(self, *args):
-        return self._get(self.parser.getboolean, *args)
+        return self._get("getboolean", *args)
 
-    def _get(self, getMethod, setting, sections, defaultVal=None):
+    def _get(self, methodName, setting, sections, defaultVal=None):
+        found, value = self.lookup(self.findValue, methodName, setting, tuple(sections))
+        return value if found else defaultVal
+
+    def findValue(self, methodName, setting, sections):
         for section in sections:
             if self.parser.has_section(section) and self.parser.has_option(section, setting):
-                return getMethod(section, setting)
-        return defaultVal
+                return True, getattr(self.parser, methodName)(section, setting)
+        return False, None
 
     def getList(self, setting, sections):
+        return list(self.lookup(self.findList, setting, tuple(sections)))
+
+    def findList(self, setting, sections):
         result = []
         for section in sections:
             if self.parser.has_section(section) and self.parser.has_option(section, setting):
                 listStr = self.parser.get(section, setting).strip()
                 if listStr:
                     result += listStr.split(",")
-        return result
+        return tuple(result)
+
+    def lookup(self, findMethod, *args):
+        key = (findMethod.__name__,) + args
+        value = self.lookupCache.get(key)
+        # The server looks settings up from many threads
+        with self.statisticsLock:
+            self.lookups += 1
+            if value is not None:
+                self.lookupHits += 1
+        if value is not None:
+            return value
+        generation = self.cacheGeneration
+        value = findMethod(*args)
+        # Don't store anything found before the settings were changed by another thread
+        if generation == self.cacheGeneration:
+            self.lookupCache[key] = value
+        return value
     
+    def getAlterations(self, sections):
+        # Compiled once per combination of sections that define alterations, until the settings change
+        alterationSections = tuple(section for section in sections if self.parser.has_section(section) and \
+                                   self.parser.has_option(section, "alterations"))
+        key = alterationSections, self.address
+        alterations = self.alterationCache.get(key)
+        if alterations is None:
+            generation = self.cacheGeneration
+            alterations = AlterationSet()
+            for alterStr in self.getList("alterations", alterationSections):
+                toFind = os.path.expandvars(self.get("match_pattern", [ alterStr ]))
+                toReplace = self.getWithAddress("replacement", [ alterStr ])
+                if toFind and toReplace is not None:
+                    alterations[re.compile(toFind)] = toReplace
+            # As for lookup, don't keep one built from settings that have changed since
+            if generation == self.cacheGeneration:
+                self.alterationCache[key] = alterations
+        return alterations
+
     def getSection(self, section):
         if self.parser.has_section(section):
             return dict(self.parser.items(section))
@@ -81,10 +145,14 @@ class RcFileHandler:
             # raises exceptions by default, but we can easily get the same mapping several times
             return False
         self.parser.add_section(section)        
+        self.clearCaches()
         return True
 
     def set(self, *args):
-        return self.parser.set(*args)
+        # Afterwards, or a lookup in another thread could cache the old value for the new generation
+        result = self.parser.set(*args)
+        self.clearCaches()
+        return result
 
     def setUpLogging(self, mainLogName):
         logConfigFile = self.get("log_config_file", [ "general" ],
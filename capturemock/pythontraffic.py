@@ -488,7 +488,7 @@ class PythonResponseTraffic(traffic.BaseTraffic):
 class PythonTrafficHandler:
     def __init__(self, replayInfo, recordFile, rcHandler, callStackChecker, interceptModules):
         self.replayInfo = replayInfo
-        self.recordFileHandler = RecordFileHandler(recordFile)
+        self.recordFileHandler = RecordFileHandler(recordFile, rcHandler)
         self.callStackChecker = callStackChecker
         self.rcHandler = rcHandler
         self.interceptModules = interceptModules
@@ -1,32 +1,83 @@
 
-""" Very basic interface for appending to a file. Server version much more complex """ 
-import os
+""" Very basic interface for appending to a file. Server version much more complex """
+import os, threading, atexit
 
 class RecordFileHandler(object):
-    def __init__(self, file):
+    def __init__(self, file, rcHandler=None):
         self.file = file
         self.lastTruncationPoint = None
         self.recordedSinceTruncationPoint = []
+        # "request" flushes everything as soon as it's recorded, "shutdown" only when we close,
+        # a number flushes at most that many milliseconds after recording
+        flushPolicy = rcHandler.get("record_flush", [ "general" ], "request") if rcHandler else "request"
+        self.flushPerRecord = flushPolicy == "request"
+        self.flushInterval = None
+        if not self.flushPerRecord and flushPolicy != "shutdown":
+            self.flushInterval = float(flushPolicy) / 1000
+        self.fsync = rcHandler is not None and rcHandler.getboolean("record_fsync", [ "general" ], False)
+        self.writeFile = None
+        self.flushTimer = None
+        self.writeLock = threading.RLock()
 
     def record(self, text, truncationPoint=False):
         if self.file:
-            if truncationPoint:
-                self.lastTruncationPoint = os.path.getsize(self.file)
-                self.recordedSinceTruncationPoint = []                
-            if self.lastTruncationPoint is not None:
-                self.recordedSinceTruncationPoint.append(text)
-            writeFile = open(self.file, "a")
-            writeFile.write(text)
-            writeFile.flush()
-            writeFile.close()
-            
+            with self.writeLock:
+                if truncationPoint:
+                    self.lastTruncationPoint = self.getCurrentSize()
+                    self.recordedSinceTruncationPoint = []
+                if self.lastTruncationPoint is not None:
+                    self.recordedSinceTruncationPoint.append(text)
+                self.getWriteFile().write(text)
+                if self.flushPerRecord:
+                    self.flush()
+                elif self.flushInterval is not None and self.flushTimer is None:
+                    self.flushTimer = threading.Timer(self.flushInterval, self.flush)
+                    self.flushTimer.daemon = True
+                    self.flushTimer.start()
+
+    def getWriteFile(self):
+        # Kept open between records, reopened if we've been closed
+        if self.writeFile is None:
+            self.writeFile = open(self.file, "a")
+            # Only while it's open, so closed handlers don't hang around until exit
+            atexit.register(self.close)
+        return self.writeFile
+
+    def getCurrentSize(self):
+        if self.writeFile:
+            self.writeFile.flush()
+        return os.path.getsize(self.file) if os.path.isfile(self.file) else 0
+
+    def flush(self):
+        with self.writeLock:
+            if self.flushTimer:
+                self.flushTimer.cancel()
+                self.flushTimer = None
+            if self.writeFile:
+                self.writeFile.flush()
+                if self.fsync:
+                    os.fsync(self.writeFile.fileno())
+
+    def close(self):
+        with self.writeLock:
+            self.flush()
+            if self.writeFile:
+                self.writeFile.close()
+                self.writeFile = None
+                atexit.unregister(self.close)
+
     def rerecord(self, oldText, newText):
         if self.file:
-            writeFile = open(self.file, "a")
-            writeFile.truncate(self.lastTruncationPoint)
-            for text in self.recordedSinceTruncationPoint:
-                writeFile.write(text.replace(oldText, newText))
-            writeFile.flush()
-            writeFile.close()
-            self.lastTruncationPoint = None
-            self.recordedSinceTruncationPoint = []
+            with self.writeLock:
+                # Everything must be in the file before we truncate it
+                self.close()
+                writeFile = open(self.file, "a")
+                writeFile.truncate(self.lastTruncationPoint)
+                for text in self.recordedSinceTruncationPoint:
+                    writeFile.write(text.replace(oldText, newText))
+                writeFile.flush()
+                if self.fsync:
+                    os.fsync(writeFile.fileno())
+                writeFile.close()
+                self.lastTruncationPoint = None
+                self.recordedSinceTruncationPoint = []
@@ -1,11 +1,13 @@
 """ Module to manage the information in the file and return appropriate matches """
 
-import logging, difflib, re, os
+import logging, difflib, re, os, pickle, hashlib, io, mmap
 from pprint import pformat
+from locale import getpreferredencoding
 try: # Python 2.7, Python 3.x
     from collections import OrderedDict
 except ImportError: # Python 2.6 and earlier
     from ordereddict import OrderedDict
+from collections import Counter
 
 from capturemock import config
 
@@ -29,9 +31,48 @@ class IdFinder:
                 return idMatch.group(0)
 
 
+class IdMappingTable:
+    """ Replaces IDs from the replay file with the ones generated this time, in one pass over the text """
+    def __init__(self):
+        self.mapping = {}
+        # As with the alterations these replace, each ID only applies to traffic using the section it was added for
+        self.sectionIds = {}
+        self.patterns = {}
+
+    def __bool__(self):
+        return bool(self.mapping)
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def __contains__(self, replayId):
+        return replayId in self.mapping
+
+    def add(self, section, replayId, recordedId):
+        self.mapping[replayId] = recordedId
+        self.sectionIds.setdefault(section, []).append(replayId)
+        self.patterns = {}
+
+    def apply(self, text, sectionNames):
+        pattern = self.getPattern(tuple(sectionNames))
+        return pattern.sub(self.replaceId, text) if pattern else text
+
+    def getPattern(self, sectionNames):
+        if sectionNames not in self.patterns:
+            replayIds = [ replayId for section in sectionNames for replayId in self.sectionIds.get(section, []) ]
+            # Longest first, so an ID that contains another one is still replaced as a whole. Anywhere in the text, as before
+            regexes = [ re.escape(replayId) for replayId in sorted(set(replayIds), key=len, reverse=True) ]
+            self.patterns[sectionNames] = re.compile("|".join(regexes)) if regexes else None
+        return self.patterns[sectionNames]
+
+    def replaceId(self, match):
+        return self.mapping[match.group(0)]
+
+
 class ReplayInfo:
     def __init__(self, mode, replayFile, rcHandler):
         self.responseMap = OrderedDict()
+        self.wordIndex = {}
         self.diag = logging.getLogger("Replay")
         self.replayItems = set()
         self.replayAll = mode == config.REPLAY
@@ -40,11 +81,37 @@ class ReplayInfo:
         self.prevResponseMapKey = None
         if replayFile:
             self.idFinder = IdFinder(rcHandler, "id_pattern_client")
-            trafficList = self.readIntoList(replayFile)
-            self.parseTrafficList(trafficList)
-            items = self.makeCommandItems(rcHandler.getIntercepts("command line")) + \
-                    self.makePythonItems(rcHandler.getIntercepts("python"))
-            self.replayItems = self.filterForReplay(items, trafficList)
+            commands = rcHandler.getIntercepts("command line")
+            pythonAttrs = rcHandler.getIntercepts("python")
+            lazy = rcHandler.getboolean("lazy_replay_loading", [ "general" ], False)
+            replayCache = None
+            if rcHandler.getboolean("use_replay_cache", [ "general" ], False):
+                replayCache = ReplayCache(replayFile, (commands, pythonAttrs, lazy))
+                if self.readFromCache(replayCache):
+                    return
+            items = self.makeCommandItems(commands) + self.makePythonItems(pythonAttrs)
+            if lazy:
+                # Responses stay in the file until they're needed. Commands and python calls only appear in requests anyway
+                self.parseTrafficList(MappedReplayFile(replayFile).iterTraffic())
+                self.replayItems = self.filterForReplay(items, self.responseMap.keys())
+            else:
+                trafficList = self.readIntoList(replayFile)
+                self.parseTrafficList(trafficList)
+                self.replayItems = self.filterForReplay(items, trafficList)
+            if replayCache:
+                replayCache.write(self.getCacheData())
+
+    def readFromCache(self, replayCache):
+        data = replayCache.read()
+        if data is None:
+            self.diag.debug("No valid replay cache found at " + replayCache.cacheFile)
+            return False
+        self.responseMap, self.wordIndex, self.replayItems = data
+        self.diag.debug("Read replay info from cache at " + replayCache.cacheFile)
+        return True
+
+    def getCacheData(self):
+        return self.responseMap, self.wordIndex, self.replayItems
 
     @staticmethod
     def filterForReplay(itemInfo, lines):
@@ -92,7 +159,7 @@ class ReplayInfo:
     def parseTrafficList(self, trafficList):
         currResponseHandlers = []
         for trafficStr in trafficList:
-            prefix = trafficStr.split(":")[0]
+            prefix = self.getTrafficPrefix(trafficStr)
             indentLevel = int(len(prefix) / 2) - 2
             fromSUT = prefix.startswith("<-")
             while self.responseCompleted(currResponseHandlers, indentLevel, fromSUT):
@@ -102,11 +169,12 @@ class ReplayInfo:
                 responseHandler, _ = currResponseHandlers[-1]
                 responseHandler.addResponse(trafficStr)
             if fromSUT or indentLevel > len(currResponseHandlers) - 1:
-                currTrafficIn = self.getTrafficLookupKey(trafficStr.strip())
+                trafficText = str(trafficStr)
+                currTrafficIn = self.getTrafficLookupKey(trafficText.strip())
                 responseHandler = self.responseMap.get(currTrafficIn)
                 if responseHandler:
                     responseHandler.newResponse()
-                    if prefix.endswith("PYT") and not "(" in trafficStr:
+                    if prefix.endswith("PYT") and not "(" in trafficText:
                         self.registerIntermediateCalls(responseHandler)
                 else:
                     responseHandler = ReplayedResponseHandler()
@@ -115,8 +183,26 @@ class ReplayInfo:
                     currResponseHandlers.append((responseHandler, fromSUT))
                 else:
                     currResponseHandlers[-1] = responseHandler, fromSUT
+        self.buildWordIndex()
         self.diag.debug("Replay info " + pformat(self.responseMap))
 
+    def getTrafficPrefix(self, trafficStr):
+        if isinstance(trafficStr, MappedTraffic):
+            return trafficStr.getPrefix()
+        else:
+            return trafficStr.split(":")[0]
+
+    def buildWordIndex(self):
+        # For each traffic type, map each word to the entries containing it and how often.
+        # Lets findBestMatch consider only entries with words in common, rather than all of them
+        self.wordIndex = {}
+        for position, currDesc in enumerate(self.responseMap):
+            words = tuple(self.getWords(currDesc))
+            entry = position, currDesc, words
+            typeIndex = self.wordIndex.setdefault(self.getTypeKey(currDesc), {})
+            for word, count in Counter(words).items():
+                typeIndex.setdefault(word, []).append((entry, count))
+
     def registerIntermediateCalls(self, currResponseHandler):
         intermediate = []
         for trafficIn in reversed(self.responseMap):
@@ -158,6 +244,16 @@ class ReplayInfo:
         else:
             return []
         
+    def getResponseTexts(self, trafficType):
+        # Responses still only in a mapped file are left there
+        for responseHandler in self.responseMap.values():
+            for trafficStrings in responseHandler.responses:
+                for trafficStr in trafficStrings:
+                    if isinstance(trafficStr, str):
+                        prefix, text = trafficStr.split(":", 1)
+                        if prefix[-3:] == trafficType:
+                            yield text
+
     def makeIdMapping(self, traffic, replayTrafficDesc):
         recordId, replayId = None, None
         if self.idFinder:
@@ -174,7 +270,7 @@ class ReplayInfo:
             if text.startswith(prefix):
                 response = responseHandler.getFirstResponse()
                 if response:
-                    return response[6:]
+                    return str(response)[6:]
 
     def getResponseMapKey(self, traffic, exact):
         desc = self.getTrafficLookupKey(traffic.getDescription())
@@ -190,23 +286,37 @@ class ReplayInfo:
 
     def findBestMatch(self, desc):
         descWords = self.getWords(desc)
-        bestMatch = None
-        bestMatchInfo = set(), 100000
-        for currDesc, responseHandler in self.responseMap.items():
-            if self.sameType(desc, currDesc):
-                descToCompare = currDesc
-                self.diag.debug("Comparing with '" + descToCompare + "'")
-                matchInfo = self.getWords(descToCompare), responseHandler.getUnmatchedResponseCount()
-                if self.isBetterMatch(matchInfo, bestMatchInfo, descWords):
-                    bestMatchInfo = matchInfo
-                    bestMatch = currDesc
+        candidates = self.findMatchCandidates(desc, descWords)
+        bestMatch, bestPosition, bestScore = None, None, None
+        # Most words in common first: the count of shared words bounds the words SequenceMatcher can find in common.
+        # Entries sharing no words at all can never be chosen, so they aren't candidates.
+        for (position, currDesc, words), maxCommon in sorted(candidates.items(), key=lambda item: (-item[1], item[0][0])):
+            if bestScore is not None and maxCommon < bestScore[0]:
+                break
+            self.diag.debug("Comparing with '" + currDesc + "'")
+            score = self.getMatchScore(words, self.responseMap[currDesc].getUnmatchedResponseCount(), descWords)
+            # Where everything is equal, prefer whatever comes first in the file
+            if bestScore is None or score > bestScore or (score == bestScore and position < bestPosition):
+                bestMatch, bestPosition, bestScore = currDesc, position, score
 
         if bestMatch is not None:
             self.diag.debug("Best match chosen as '" + bestMatch + "'")
             return bestMatch
 
+    def findMatchCandidates(self, desc, descWords):
+        typeIndex = self.wordIndex.get(self.getTypeKey(desc), {})
+        candidates = {}
+        for word, count in Counter(descWords).items():
+            for entry, entryCount in typeIndex.get(word, []):
+                candidates[entry] = candidates.get(entry, 0) + min(count, entryCount)
+        self.diag.debug("Found " + str(len(candidates)) + " candidates with words in common")
+        return candidates
+
     def sameType(self, desc1, desc2):
-        return desc1[2:5] == desc2[2:5]
+        return self.getTypeKey(desc1) == self.getTypeKey(desc2)
+
+    def getTypeKey(self, desc):
+        return desc[2:5]
 
     def getWords(self, desc):
         # Heuristic decisions trying to make the best of inexact matches
@@ -239,29 +349,14 @@ class ReplayInfo:
         return blocks[-2].a + blocks[-2].size == blocks[-1].a and \
                blocks[-2].b + blocks[-2].size == blocks[-1].b
 
-    def isBetterMatch(self, info1, info2, targetWords):
-        words1, unmatchedCount1 = info1
-        words2, unmatchedCount2 = info2
-        blocks1 = self.getMatchingBlocks(words1, targetWords)
-        blocks2 = self.getMatchingBlocks(words2, targetWords)
-        common1 = self.commonElementCount(blocks1)
-        common2 = self.commonElementCount(blocks2)
-        self.diag.debug("Words in common " + repr(common1) + " vs " + repr(common2))
-        if common1 > common2:
-            return True
-        elif common1 < common2:
-            return False
-
-        nonMatchCount1 = self.nonMatchingSequenceCount(blocks1)
-        nonMatchCount2 = self.nonMatchingSequenceCount(blocks2)
-        self.diag.debug("Non matching sequences " + repr(nonMatchCount1) + " vs " + repr(nonMatchCount2))
-        if nonMatchCount1 < nonMatchCount2:
-            return True
-        elif nonMatchCount1 > nonMatchCount2:
-            return False
-
-        self.diag.debug("Unmatched count difference " + repr(unmatchedCount1) + " vs " + repr(unmatchedCount2))
-        return unmatchedCount1 > unmatchedCount2
+    def getMatchScore(self, words, unmatchedCount, targetWords):
+        # Higher is better: words in common, then fewest non-matching sequences, then most responses left
+        blocks = self.getMatchingBlocks(words, targetWords)
+        common = self.commonElementCount(blocks)
+        nonMatchCount = self.nonMatchingSequenceCount(blocks)
+        self.diag.debug("Words in common " + repr(common) + ", non matching sequences " + repr(nonMatchCount) +
+                        ", unmatched count " + repr(unmatchedCount))
+        return common, -nonMatchCount, unmatchedCount
 
 
 # Need to handle multiple replies to the same question
@@ -314,7 +409,7 @@ class ReplayedResponseHandler:
         trafficStrings, increment = self.getCurrentStrings(responseIndex)
         responses = []
         for trafficStr in trafficStrings:
-            prefix, text = trafficStr.split(":", 1)
+            prefix, text = str(trafficStr).split(":", 1)
             trafficType = prefix[-3:]
             for trafficClass in allClasses:
                 if trafficClass.typeId == trafficType:
@@ -326,6 +421,140 @@ class ReplayedResponseHandler:
         return responses
     
 
+class MappedReplayFile:
+    """ Replay file accessed via mmap, so traffic text need only be decoded when it's used """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.encoding = getpreferredencoding(False) # what open() would use
+        self.mmap = None
+
+    def __getstate__(self):
+        # For the replay cache: the mapping itself can't be stored, reopen it when needed
+        return { "fileName" : self.fileName, "encoding" : self.encoding }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.mmap = None
+
+    def getMap(self):
+        if self.mmap is None:
+            with open(self.fileName, "rb") as f:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mmap
+
+    def iterTraffic(self):
+        # Same division into traffic as ReplayInfo.readIntoList, but only keeps the offsets
+        if os.path.getsize(self.fileName) == 0:
+            return
+        mappedFile = self.getMap()
+        start, pos = 0, 0
+        while True:
+            line = mappedFile.readline()
+            if not line:
+                break
+            prefix = line[:10].split(b":")[0]
+            if len(prefix) < 10 and (prefix.startswith(b"<-") or prefix[-5:-3] == b"->") and pos > start:
+                yield MappedTraffic(self, start, pos)
+                start = pos
+            pos += len(line)
+        if pos > start:
+            yield MappedTraffic(self, start, pos)
+
+    def getPrefix(self, start, end):
+        mappedFile = self.getMap()
+        colonPos = mappedFile.find(b":", start, end)
+        prefixEnd = colonPos if colonPos != -1 else end
+        return mappedFile[start:prefixEnd].decode(self.encoding)
+
+    def decode(self, start, end):
+        text = self.getMap()[start:end].decode(self.encoding)
+        return text.replace("\r\n", "\n").rstrip("\n")
+
+
+class MappedTraffic:
+    """ Traffic string still in the replay file. str() reads it from there """
+    __slots__ = ("replayFile", "start", "end")
+    def __init__(self, replayFile, start, end):
+        self.replayFile = replayFile
+        self.start = start
+        self.end = end
+
+    def __getstate__(self):
+        return self.replayFile, self.start, self.end
+
+    def __setstate__(self, state):
+        self.replayFile, self.start, self.end = state
+
+    def __str__(self):
+        return self.replayFile.decode(self.start, self.end)
+
+    def __repr__(self):
+        # Don't read it just for logging
+        return "<bytes " + str(self.start) + "-" + str(self.end) + " of " + self.replayFile.fileName + ">"
+
+    def getPrefix(self):
+        return self.replayFile.getPrefix(self.start, self.end)
+
+
+class ReplayCache:
+    """ Compiled form of a replay file, stored next to it, so unchanged files need not be parsed again """
+    suffix = ".replaycache"
+    version = 1 # change whenever what ReplayInfo stores in it changes
+    def __init__(self, replayFile, settings):
+        self.replayFile = replayFile
+        self.cacheFile = replayFile + self.suffix
+        # Anything else, besides the file itself, that the cached data depends on
+        self.settings = settings
+        self.diag = logging.getLogger("Replay")
+
+    def getFileInfo(self):
+        statObj = os.stat(self.replayFile)
+        return statObj.st_mtime_ns, statObj.st_size
+
+    def getContentHash(self):
+        with open(self.replayFile, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def read(self):
+        if not os.path.isfile(self.cacheFile):
+            return
+        try:
+            with open(self.cacheFile, "rb") as f:
+                unpickler = pickle.Unpickler(io.BytesIO(f.read()))
+                version, settings, mtime, size, contentHash = unpickler.load()
+                if version != self.version or settings != self.settings:
+                    return
+                currMtime, currSize = self.getFileInfo()
+                if size != currSize:
+                    return
+                if mtime != currMtime:
+                    # e.g. checked out again, only trust the cache if the contents are the same
+                    if contentHash != self.getContentHash():
+                        return
+                    data = unpickler.load()
+                    self.write(data, contentHash)
+                    return data
+                return unpickler.load()
+        except Exception as e:
+            # Not being able to use the cache shouldn't stop us: we just parse the file as usual
+            self.diag.debug("Failed to read replay cache " + self.cacheFile + " : " + str(e))
+
+    def write(self, data, contentHash=None):
+        mtime, size = self.getFileInfo()
+        header = self.version, self.settings, mtime, size, contentHash or self.getContentHash()
+        tmpFile = self.cacheFile + "." + str(os.getpid())
+        try:
+            with open(tmpFile, "wb") as f:
+                pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpFile, self.cacheFile)
+            self.diag.debug("Wrote replay cache to " + self.cacheFile)
+        except Exception as e:
+            self.diag.debug("Failed to write replay cache " + self.cacheFile + " : " + str(e))
+            if os.path.isfile(tmpFile):
+                os.remove(tmpFile)
+
+
 def filterFileForReplay(itemInfo, replayFile):
     with open(replayFile, newline=None) as f:
         return ReplayInfo.filterForReplay(itemInfo, f)
@@ -1,16 +1,18 @@
-import os, stat, sys, socket, threading, time, subprocess
+import os, stat, sys, socket, threading, time, subprocess, queue, asyncio, tempfile, logging
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
 
 from capturemock import config
-from capturemock.replayinfo import ReplayInfo, IdFinder
+from capturemock.replayinfo import ReplayInfo, IdFinder, IdMappingTable
 from capturemock import recordfilehandler, cmdlineutils
 from capturemock import commandlinetraffic, fileedittraffic, clientservertraffic, customtraffic
 from locale import getpreferredencoding
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict, namedtuple, deque
 
 from urllib.request import urlopen
 from urllib.parse import urlparse, urlunparse
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import BaseHTTPRequestHandler
 from socketserver import TCPServer, StreamRequestHandler
 from xmlrpc.client import Fault, ServerProxy
 from xmlrpc.server import SimpleXMLRPCServer
@@ -88,21 +90,86 @@ def stopServer(servAddr, protocol):
                   ", seemed not to be running anyway.", file=sys.stderr)
 
 
+class RequestThreadPool:
+    """ A fixed number of threads processing queued requests, rather than a new thread for every request """
+    def __init__(self, size, queueSize, diag):
+        self.diag = diag
+        self.queue = queue.Queue(queueSize) # 0 means no limit
+        self.inFlight = 0
+        self.lock = threading.Lock()
+        self.threads = [ threading.Thread(target=self.runWorker, name="request") for _ in range(size) ]
+        for t in self.threads:
+            t.start()
+
+    def getInFlightCount(self):
+        with self.lock:
+            return self.inFlight
+
+    def getQueuedCount(self):
+        return self.queue.qsize()
+
+    def submit(self, method, *args):
+        # Blocks when the queue is full, so we stop accepting new connections until the workers catch up
+        self.queue.put((method, args))
+        self.diag.debug("Queued request, " + str(self.getInFlightCount()) + " in flight, " +
+                        str(self.getQueuedCount()) + " queued")
+
+    def runWorker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            method, args = item
+            with self.lock:
+                self.inFlight += 1
+            try:
+                method(*args)
+            finally:
+                with self.lock:
+                    self.inFlight -= 1
+
+    def shutdown(self):
+        # Anything already queued is processed before the workers see these
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
+
 class ClassicTrafficServer(TCPServer):
     @classmethod
     def createServer(cls, address, dispatcher):
         ClassicTrafficRequestHandler.dispatcher = dispatcher
-        return cls((address, 0), ClassicTrafficRequestHandler, dispatcher.useThreads)
+        threadPool = None
+        if dispatcher.useThreads:
+            # Each thread might be waiting for a command which itself is intercepted, so don't make this too small
+            poolSize = int(dispatcher.rcHandler.get("server_thread_pool_size", [ "general" ], 0))
+            if poolSize > 0:
+                queueSize = int(dispatcher.rcHandler.get("server_thread_queue_size", [ "general" ], 0))
+                threadPool = RequestThreadPool(poolSize, queueSize, dispatcher.diag)
+        return cls((address, 0), ClassicTrafficRequestHandler, dispatcher.useThreads, threadPool)
     
-    def __init__(self, addrinfo, handlerClass, useThreads):
+    def __init__(self, addrinfo, handlerClass, useThreads, threadPool=None):
         TCPServer.__init__(self, addrinfo, handlerClass)
         self.useThreads = useThreads
+        self.threadPool = threadPool
         self.terminate = False
         self.requestCount = 0
 
+    def getInFlightCount(self):
+        if self.threadPool:
+            return self.threadPool.getInFlightCount()
+        else:
+            return len([ t for t in threading.enumerate() if t.name == "request" ])
+
+    def getQueuedCount(self):
+        return self.threadPool.getQueuedCount() if self.threadPool else 0
+
     def run(self):
         while not self.terminate:
             self.handle_request()
+        if self.threadPool:
+            self.threadPool.shutdown()
         # Join all remaining request threads so they don't
         # execute after Python interpreter has started to shut itself down.
         for t in threading.enumerate():
@@ -142,7 +209,10 @@ class ClassicTrafficServer(TCPServer):
 
     def process_request(self, request, client_address):
         self.requestCount += 1
-        if self.useThreads:
+        if self.useThreads and self.threadPool:
+            # Request numbers are still assigned here, in the order the requests arrive
+            self.threadPool.submit(self.process_request_thread, request, client_address, self.requestCount)
+        elif self.useThreads:
             """Start a new thread to process the request."""
             t = threading.Thread(target = self.process_request_thread, name="request",
                                  args = (request, client_address, self.requestCount))
@@ -176,10 +246,47 @@ class ClassicTrafficRequestHandler(StreamRequestHandler):
 class HTTPTrafficHandler(BaseHTTPRequestHandler):
     dispatcher = None
     redirects = []
-    requestCount = 0
+    protocol_version = "HTTP/1.1" # keep connections open where the client allows it
+    def __init__(self, requestNumber, rfile, connection, client_address, server, lastOnConnection=False):
+        # HTTPTrafficServer has already read the request, so we don't set up from a socket like a normal StreamRequestHandler
+        self.requestNumber = requestNumber
+        self.rfile = rfile
+        self.wfile = connection
+        self.request = connection
+        self.client_address = client_address
+        self.server = server
+        self.lastOnConnection = lastOnConnection
+        self.processed = False
+
+    def process(self, traffic):
+        self.dispatcher.process(traffic, self.requestNumber)
+        self.processed = True
+
     def read_data(self):
-        content_length = int(self.headers['Content-Length']) # <--- Gets the size of data
-        return self.rfile.read(content_length)
+        # HTTPTrafficServer has read exactly the body, whichever way it was framed
+        return self.rfile.read()
+
+    def handle_expect_100(self):
+        return True # HTTPTrafficServer sent the continue response before it read the body
+
+    def end_headers(self):
+        if self.lastOnConnection:
+            self.send_header("Connection", "close")
+        BaseHTTPRequestHandler.end_headers(self)
+
+    def make_response_head(self, code, headerBlock):
+        # What send_response_only, send_header and end_headers would write, so the body can go in the same write
+        message = self.responses[code][0] if code in self.responses else ""
+        head = ("%s %d %s\r\n" % (self.protocol_version, code, message)).encode("latin-1", "strict") + headerBlock
+        if self.lastOnConnection:
+            self.close_connection = True
+            head += b"Connection: close\r\n"
+        return head + b"\r\n"
+
+    def send_empty_response(self, code):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
     
     def log_message(self, format, *args):
         self.dispatcher.diag.debug(format % args)
@@ -194,6 +301,7 @@ class HTTPTrafficHandler(BaseHTTPRequestHandler):
             if redirectKey in self.path:
                 self.send_response(307)
                 self.send_header('Location', target + self.path)
+                self.send_header("Content-Length", "0")
                 self.end_headers()
                 return True
         return False
@@ -201,15 +309,13 @@ class HTTPTrafficHandler(BaseHTTPRequestHandler):
     def do_GET(self):
         if self.try_redirect():
             return
-        HTTPTrafficHandler.requestCount += 1
         if self.path == "/capturemock/shutdownServer":
-            self.send_response(200)
-            self.end_headers()
+            self.send_empty_response(200)
             self.dispatcher.server.setShutdownFlag()
         else:
             traffic = clientservertraffic.HTTPClientTraffic(responseFile=self.wfile, method="GET", path=self.get_local_path(), headers=self.headers, 
                                                             rcHandler=self.dispatcher.rcHandler, handler=self)
-            self.dispatcher.process(traffic, self.requestCount)
+            self.process(traffic)
 
     def do_POST(self):
         rawbytes = self.read_data()
@@ -223,36 +329,31 @@ class HTTPTrafficHandler(BaseHTTPRequestHandler):
             redirectKey = self.path.rsplit("/", 1)[-1]
             target = rawbytes.decode(getpreferredencoding())
             self.redirects.append((redirectKey, target))
-            self.send_response(200)
-            self.end_headers()
+            self.send_empty_response(200)
             return
         
         if self.path == "/capturemock/addAlterations":
             rcFile = rawbytes.decode(getpreferredencoding())
             self.dispatcher.rcHandler.addFile(rcFile)
-            self.send_response(200)
-            self.end_headers()
+            self.send_empty_response(200)
             return
         
-        HTTPTrafficHandler.requestCount += 1
         if self.path == "/capturemock/setServerLocation":
             text = rawbytes.decode(getpreferredencoding())
             traffic = clientservertraffic.HTTPServerStateTraffic(text, rcHandler=self.dispatcher.rcHandler)
-            self.send_response(200)
-            self.end_headers()
+            self.send_empty_response(200)
         else:
             traffic = clientservertraffic.HTTPClientTraffic(rawbytes, self.wfile, method="POST", path=self.get_local_path(), headers=self.headers, 
                                                             rcHandler=self.dispatcher.rcHandler, handler=self)
-        self.dispatcher.process(traffic, self.requestCount)
+        self.process(traffic)
         
     def do_method_with_payload(self, method):
         if self.try_redirect():
             return
-        HTTPTrafficHandler.requestCount += 1
         rawbytes = self.read_data()
         traffic = clientservertraffic.HTTPClientTraffic(rawbytes, self.wfile, method=method, path=self.get_local_path(), headers=self.headers, 
                                                         rcHandler=self.dispatcher.rcHandler, handler=self)
-        self.dispatcher.process(traffic, self.requestCount)
+        self.process(traffic)
 
     def do_PATCH(self):
         self.do_method_with_payload("PATCH")
@@ -263,43 +364,187 @@ class HTTPTrafficHandler(BaseHTTPRequestHandler):
     def do_DELETE(self):
         if self.try_redirect():
             return
-        HTTPTrafficHandler.requestCount += 1
         traffic = clientservertraffic.HTTPClientTraffic(responseFile=self.wfile, method="DELETE", path=self.get_local_path(), headers=self.headers, 
                                                         rcHandler=self.dispatcher.rcHandler, handler=self)
-        self.dispatcher.process(traffic, self.requestCount)
+        self.process(traffic)
     
     def do_OPTIONS(self):
         self.send_response(200, "ok")
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header("Access-Control-Allow-Headers", '*')
         self.send_header('Access-Control-Allow-Methods', '*')
+        self.send_header("Content-Length", "0")
         self.end_headers()
         
         
         
 
-class HTTPTrafficServer(HTTPServer):
+class HTTPConnectionWriter:
+    """ File-like access to an asyncio connection, for the threads processing the requests """
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.written = False
+
+    def write(self, data):
+        self.written = True
+        self.loop.call_soon_threadsafe(self.writer.write, bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass # written by the event loop as soon as it can
+
+    def drain(self):
+        # For writers of large amounts, so the event loop doesn't buffer more than the client has read
+        asyncio.run_coroutine_threadsafe(self.writer.drain(), self.loop).result()
+
+    def sendfile(self, file, offset, count):
+        # Straight from the file to the socket where the platform allows it, after anything already written
+        self.written = True
+        if not self.writer.transport.is_closing():
+            coroutine = self.loop.sendfile(self.writer.transport, file, offset, count)
+            asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+class HTTPTrafficServer:
+    defaultThreadCount = 100
+    headerLimit = 1024 * 1024
+    backlog = 500
     @classmethod
     def createServer(cls, address, dispatcher):
         HTTPTrafficHandler.dispatcher = dispatcher
-        return cls((address, 0))
+        return cls((address, 0), dispatcher)
     
-    def __init__(self, address):
-        HTTPServer.__init__(self, address, HTTPTrafficHandler)
+    def __init__(self, address, dispatcher):
+        self.dispatcher = dispatcher
+        self.requestCount = 0
+        self.readingTasks = set()
+        self.processingTasks = set()
+        self.shuttingDown = False
+        self.idleTimeout = float(dispatcher.rcHandler.get("http_keepalive_timeout", [ "general" ], 5))
+        self.maxRequestsPerConnection = int(dispatcher.rcHandler.get("http_max_requests_per_connection", [ "general" ], 100))
+        # Connections are handled in the event loop, but the requests themselves are processed in threads:
+        # processing traffic means blocking calls, e.g. forwarding to the real server
+        threadCount = 1
+        if dispatcher.useThreads:
+            threadCount = int(dispatcher.rcHandler.get("server_thread_pool_size", [ "general" ], 0)) or self.defaultThreadCount
+        self.executor = ThreadPoolExecutor(threadCount, thread_name_prefix="request")
+        self.loop = asyncio.new_event_loop()
+        host, port = address
+        serverCoroutine = asyncio.start_server(self.handleConnection, host, port, limit=self.headerLimit, backlog=self.backlog)
+        self.server = self.loop.run_until_complete(serverCoroutine)
     
     def run(self):
-        self.serve_forever()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.shuttingDown = True
+            self.server.close()
+            # Requests not yet read, or idle connections, can be dropped.
+            # But those being processed should be completed and recorded
+            for task in self.readingTasks:
+                task.cancel()
+            pendingTasks = self.readingTasks | self.processingTasks
+            if pendingTasks:
+                self.loop.run_until_complete(asyncio.wait(pendingTasks))
+            # Every connection is closed by now. Newer Pythons wait for them here, so it must come last
+            self.loop.run_until_complete(self.server.wait_closed())
+            self.executor.shutdown()
+            self.loop.close()
+
+    async def handleConnection(self, reader, writer):
+        task = asyncio.current_task()
+        requestsOnConnection = 0
+        try:
+            while not self.shuttingDown:
+                self.readingTasks.add(task)
+                try:
+                    # No time limit for the first request, as before. After that we're just keeping an idle connection open
+                    timeout = self.idleTimeout if requestsOnConnection else None
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+                    head, body = await self.readBody(head, reader, writer)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError, ValueError):
+                    break
+                except asyncio.CancelledError:
+                    break # shutting down
+                finally:
+                    self.readingTasks.discard(task)
+
+                # Number the requests here, in the order they arrive, whatever order they complete in
+                self.requestCount += 1
+                requestsOnConnection += 1
+                lastOnConnection = requestsOnConnection >= self.maxRequestsPerConnection
+                self.processingTasks.add(task)
+                try:
+                    connection = HTTPConnectionWriter(self.loop, writer)
+                    clientAddress = writer.get_extra_info("peername")
+                    keepAlive = await self.loop.run_in_executor(self.executor, self.handleRequest, self.requestCount,
+                                                                head + body, connection, clientAddress, lastOnConnection)
+                finally:
+                    self.processingTasks.discard(task)
+                if not keepAlive:
+                    break
+        finally:
+            writer.close()
+
+    def parseHeaders(self, head):
+        headers = {}
+        for line in head.split(b"\r\n")[1:]:
+            header, _, value = line.partition(b":")
+            headers[header.strip().lower()] = value.strip()
+        return headers
+
+    async def readBody(self, head, reader, writer):
+        headers = self.parseHeaders(head)
+        if headers.get(b"expect", b"").lower() == b"100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        if headers.get(b"transfer-encoding", b"").lower() == b"chunked":
+            body = await self.readChunkedBody(reader)
+            # Pass it on as if it had been sent with a length: the body is only processed once it's all here anyway
+            lines = [ line for line in head.split(b"\r\n") if not line.lower().startswith(b"transfer-encoding:") ]
+            lines.insert(1, b"Content-Length: " + str(len(body)).encode())
+            return b"\r\n".join(lines), body
+        else:
+            return head, await reader.readexactly(int(headers.get(b"content-length", 0)))
+
+    async def readChunkedBody(self, reader):
+        chunks = []
+        while True:
+            sizeLine = await reader.readuntil(b"\r\n")
+            size = int(sizeLine.split(b";")[0], 16)
+            if size == 0:
+                # Skip any trailers, up to the blank line
+                while await reader.readuntil(b"\r\n") != b"\r\n":
+                    pass
+                return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    def handleRequest(self, requestNumber, data, connection, clientAddress, lastOnConnection):
+        handler = None
+        try:
+            handler = HTTPTrafficHandler(requestNumber, BytesIO(data), connection, clientAddress, self, lastOnConnection)
+            handler.handle_one_request()
+        except Exception:
+            sys.stderr.write("Exception thrown while handling HTTP request :\n")
+            from traceback import format_exc
+            sys.stderr.write(format_exc())
+        finally:
+            if handler is None or not handler.processed:
+                # Nothing was recorded for this request number: later requests mustn't wait for it
+                self.dispatcher.recordFileHandler.requestComplete(requestNumber)
+        # If we didn't send any response, e.g. forwarding failed, closing is the only way to tell the client
+        return handler is not None and connection.written and not handler.close_connection and not lastOnConnection
 
     def getAddress(self):
-        host, port = self.socket.getsockname()
+        host, port = self.server.sockets[0].getsockname()[:2]
         # hardcode http? Seems to be what you get...
         return "http://" + host + ":" + str(port)
 
     def setShutdownFlag(self):
-        # Not supposed to know about this variable, implementation detail of SocketServer
-        # But seems like the only way to shutdown the server from within a request
-        # Otherwise we have to start using ForkingMixin, ThreadingMixin etc which seems like overkill just to access a variable
-        self._BaseServer__shutdown_request = True
+        # Called from within a request: whatever is still being processed is finished off in run()
+        self.shuttingDown = True
+        self.loop.call_soon_threadsafe(self.loop.stop)
 
     @staticmethod
     def getTrafficClasses(incoming):
@@ -385,7 +630,7 @@ class ServerDispatcherBase:
         self.filesToIgnore = self.rcHandler.getList("ignore_edits", [ "command line" ])
         self.useThreads = self.rcHandler.getboolean("server_multithreaded", [ "general" ], True)
         self.replayInfo = ReplayInfo(options.mode, options.replay, self.rcHandler)
-        self.recordFileHandler = RecordFileHandler(options.record)
+        self.recordFileHandler = RecordFileHandler(options.record, self.rcHandler)
         self.topLevelForEdit = [] # contains only paths explicitly given. Always present.
         self.fileEditData = OrderedDict() # contains all paths, including subpaths of the above. Empty when replaying.
         self.hasAsynchronousEdits = False
@@ -473,7 +718,7 @@ class ServerDispatcherBase:
                 value = text[len(prefix):]
                 return cls(value, wfile, self.rcHandler)
 
-    def process(self, traffic, reqNo):
+    def process(self, traffic, reqNo, completeRequest=True):
         if not self.replayInfo.isActiveFor(traffic):
             # If we're recording, check for file changes before we do
             # Must do this before as they may be a side effect of whatever it is we're processing
@@ -481,7 +726,8 @@ class ServerDispatcherBase:
                 self._process(fileTraffic, reqNo)
 
         responses = self._process(traffic, reqNo)
-        self.recordFileHandler.requestComplete(reqNo)
+        if completeRequest:
+            self.recordFileHandler.requestComplete(reqNo)
         return responses
 
     def _process(self, traffic, reqNo):
@@ -661,6 +907,8 @@ class ServerDispatcher(ServerDispatcherBase):
     def run(self):
         self.diag.debug("Starting capturemock server at " + self.server.getAddress())
         self.server.run()
+        self.recordFileHandler.close()
+        self.diag.debug(self.rcHandler.getLookupStatistics())
         self.diag.debug("Shut down capturemock server")
         
     def shutdown(self):
@@ -675,8 +923,9 @@ class ReplayOnlyDispatcher(ServerDispatcherBase):
         options = ReplayOptions(mode=config.RECORD, replay=None, record=recordFile, rcfiles=rcFile)
         ServerDispatcherBase.__init__(self, options)
         self.idFinder = IdFinder(self.rcHandler, "id_pattern_server")
+        self.rcHandler.idMapping = IdMappingTable()
         self.clientTrafficStrings = []
-        self.replay_ids = []
+        self.replay_ids = deque()
         self.diag.debug("Replaying everything as client from " + replayFile)
         for trafficStr in ReplayInfo.readIntoList(replayFile):
             if trafficStr.startswith("<-"):
@@ -703,15 +952,13 @@ class ReplayOnlyDispatcher(ServerDispatcherBase):
         return ids
             
     def add_id_mapping(self, traffic, replay_id, recorded_id):
-        if self.rcHandler.add_section(replay_id):
-            sectionNames = traffic.getAlterationSectionNames()
-            self.rcHandler.addToList("alterations", sectionNames, replay_id)
-            self.rcHandler.set(replay_id, "match_pattern", replay_id)
-            self.rcHandler.set(replay_id, "replacement", recorded_id)
+        # Applied to later traffic with the same alteration sections, before the other alterations
+        if replay_id not in self.rcHandler.idMapping:
+            self.rcHandler.idMapping.add(traffic.getAlterationSectionNames()[0], replay_id, recorded_id)
 
     def replay_all(self, **kw):
         # Pulls everything out of replay info - then we go to "record" mode
-        recorded_ids = []
+        recorded_ids = set()
         alterations = {}
         for i, text in enumerate(self.clientTrafficStrings):
             self.diag.debug("Replaying traffic with text beginning " + text[:30] + "...")
@@ -719,11 +966,12 @@ class ReplayOnlyDispatcher(ServerDispatcherBase):
             responses = self.process(traffic, i + 1)
             for currId in self.extractIdsFromResponses(responses):
                 if currId not in recorded_ids:
-                    recorded_ids.append(currId)
-                    replay_id = self.replay_ids.pop(0)
+                    recorded_ids.add(currId)
+                    replay_id = self.replay_ids.popleft()
                     self.diag.debug("Adding ID mapping from " + replay_id + " to " + currId)
                     alterations[replay_id] = currId
                     self.add_id_mapping(traffic, replay_id, currId)
+        self.recordFileHandler.close()
         self.diag.debug("Replaying all now complete")
         return alterations
     
@@ -738,42 +986,79 @@ class ReplayOnlyDispatcher(ServerDispatcherBase):
 # file in the order in which it comes in, not in the order in which it completes (which is indeterministic and
 # may be wrong next time around)
 class RecordFileHandler(recordfilehandler.RecordFileHandler):
-    def __init__(self, file):
-        super(RecordFileHandler, self).__init__(file)
+    spillBlockSize = 65536
+    def __init__(self, file, rcHandler=None):
+        super(RecordFileHandler, self).__init__(file, rcHandler)
         self.recordingRequest = 1
+        # Text for requests we can't write yet, as lists of chunks, or spilled to temporary files
+        # once more than the buffer limit is held in memory
         self.cache = {}
-        self.completedRequests = []
+        self.cacheSizes = {}
+        self.spilled = {}
+        self.bufferedSize = 0
+        self.bufferLimit = int(rcHandler.get("record_buffer_limit", [ "general" ], 10 * 1024 * 1024)) if rcHandler else 10 * 1024 * 1024
+        self.completedRequests = set()
         self.lock = threading.Lock()
+        self.diag = logging.getLogger("Server")
 
     def requestComplete(self, requestNumber):
-        self.lock.acquire()
-        if requestNumber == self.recordingRequest:
-            self.recordingRequestComplete()
-        else:
-            self.completedRequests.append(requestNumber)
-        self.lock.release()
+        with self.lock:
+            if requestNumber == self.recordingRequest:
+                self.recordingRequestComplete()
+            else:
+                self.completedRequests.add(requestNumber)
 
     def writeFromCache(self):
-        text = self.cache.get(self.recordingRequest)
-        if text:
-            super(RecordFileHandler, self).record(text)
-            del self.cache[self.recordingRequest]
+        spillFile = self.spilled.pop(self.recordingRequest, None)
+        if spillFile:
+            spillFile.seek(0)
+            block = spillFile.read(self.spillBlockSize)
+            while block:
+                super(RecordFileHandler, self).record(block)
+                block = spillFile.read(self.spillBlockSize)
+            spillFile.close()
+        chunks = self.cache.pop(self.recordingRequest, None)
+        if chunks:
+            self.bufferedSize -= self.cacheSizes.pop(self.recordingRequest)
+            super(RecordFileHandler, self).record("".join(chunks))
 
     def recordingRequestComplete(self):
         self.writeFromCache()
         self.recordingRequest += 1
-        if self.recordingRequest in self.completedRequests:
-            self.recordingRequestComplete()
+        while self.recordingRequest in self.completedRequests:
+            self.completedRequests.remove(self.recordingRequest)
+            self.writeFromCache()
+            self.recordingRequest += 1
 
     def record(self, text, requestNumber):
-        self.lock.acquire()
-        if requestNumber == self.recordingRequest:
-            self.writeFromCache()
-            super(RecordFileHandler, self).record(text)
-        else:
-            self.cache.setdefault(requestNumber, "")
-            self.cache[requestNumber] += text
-        self.lock.release()
+        with self.lock:
+            if requestNumber == self.recordingRequest:
+                self.writeFromCache()
+                super(RecordFileHandler, self).record(text)
+            elif requestNumber in self.spilled:
+                self.spilled[requestNumber].write(text)
+            else:
+                self.cache.setdefault(requestNumber, []).append(text)
+                self.cacheSizes[requestNumber] = self.cacheSizes.get(requestNumber, 0) + len(text)
+                self.bufferedSize += len(text)
+                while self.bufferedSize > self.bufferLimit:
+                    self.spillLargest()
+
+    def spillLargest(self):
+        # Moves the biggest in-memory buffer to disk, it is read back when its turn comes
+        requestNumber = max(self.cacheSizes, key=self.cacheSizes.get)
+        spillFile = tempfile.TemporaryFile(mode="w+", encoding="utf-8", newline="")
+        spillFile.writelines(self.cache.pop(requestNumber))
+        self.bufferedSize -= self.cacheSizes.pop(requestNumber)
+        self.spilled[requestNumber] = spillFile
+        self.diag.debug("Spilled recorded text for request " + str(requestNumber) + " to disk")
+
+    def close(self):
+        with self.lock:
+            for spillFile in self.spilled.values():
+                spillFile.close()
+            self.spilled = {}
+        super(RecordFileHandler, self).close()
 
 
 def main():
@@ -1,7 +1,6 @@
 """ Defining the base traffic class which the useful traffic classes inherit """
 
 import re
-import os
 import sys
 from datetime import datetime
 
@@ -11,19 +10,142 @@ try:
 except ImportError:
     from ordereddict import OrderedDict
 
+class AlterationSet(OrderedDict):
+    """ Alterations as compiled regex -> replacement, applied in reverse order of addition """
+    regexChars = set(".^$*+?{}[]|()")
+    def __init__(self, *args, **kw):
+        OrderedDict.__init__(self, *args, **kw)
+        self.compiled = None
+
+    def __setitem__(self, regex, repl):
+        OrderedDict.__setitem__(self, regex, repl)
+        self.compiled = None
+
+    def __delitem__(self, regex):
+        OrderedDict.__delitem__(self, regex)
+        self.compiled = None
+
+    def apply(self, text, storeVariable):
+        if not self:
+            return text
+        if self.compiled is None:
+            self.compiled = self.compilePasses()
+        anyMatchRegex, passes = self.compiled
+        if anyMatchRegex is not None and not anyMatchRegex.search(text):
+            return text
+        for regex, repl, kind in passes:
+            if kind == "literal":
+                if regex in text:
+                    text = text.replace(regex, repl)
+            elif kind == "variable":
+                text = regex.sub(lambda match: storeVariable(repl, match.group(0)), text)
+            elif kind == "expand":
+                text = regex.sub(lambda match: match.expand(repl), text)
+            else:
+                text = regex.sub(repl, text)
+        return text
+
+    def compilePasses(self):
+        # Plain literal replacements that cannot interfere with each other are merged into one pass
+        # which looks them up in a table, everything else keeps its own pass, in the same order as before
+        passes = []
+        literalRun = OrderedDict()
+        for regex, repl in reversed(list(self.items())):
+            literal = self.getLiteral(regex)
+            if literal is not None and not repl.startswith("$") and "\\" not in repl:
+                if not self.canJoinRun(literalRun, literal):
+                    self.addLiteralPass(passes, literalRun)
+                    literalRun = OrderedDict()
+                literalRun[literal] = repl
+            else:
+                self.addLiteralPass(passes, literalRun)
+                literalRun = OrderedDict()
+                passes.append((regex, repl, self.getRegexKind(regex, repl)))
+        self.addLiteralPass(passes, literalRun)
+        return self.makeAnyMatchRegex(), passes
+
+    @staticmethod
+    def addLiteralPass(passes, literalRun):
+        if len(literalRun) == 1:
+            literal, repl = list(literalRun.items())[0]
+            passes.append((literal, repl, "literal"))
+        elif literalRun:
+            regex = re.compile("|".join(map(re.escape, sorted(literalRun, key=len, reverse=True))))
+            passes.append((regex, lambda match: literalRun[match.group(0)], "regex"))
+
+    @staticmethod
+    def getRegexKind(regex, repl):
+        if repl.startswith("$"):
+            return "variable"
+        try:
+            # Invalid templates are only a problem if something matches, so check them in advance
+            regex.sub(repl, "")
+            return "regex"
+        except (re.error, IndexError):
+            return "expand"
+
+    @classmethod
+    def getLiteral(cls, regex):
+        if regex.flags != re.UNICODE:
+            return
+        chars = []
+        escaped = False
+        for char in regex.pattern:
+            if escaped:
+                if char.isalnum():
+                    return
+                chars.append(char)
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char in cls.regexChars:
+                return
+            else:
+                chars.append(char)
+        if chars and not escaped:
+            return "".join(chars)
+
+    @classmethod
+    def canJoinRun(cls, literalRun, literal):
+        for otherLiteral, otherRepl in literalRun.items():
+            # Later literals must not overlap earlier ones or anything they were replaced with
+            if cls.overlaps(literal, otherLiteral) or cls.overlaps(literal, otherRepl):
+                return False
+        return True
+
+    @staticmethod
+    def overlaps(text1, text2):
+        if text1 in text2 or text2 in text1:
+            return True
+        for length in range(1, min(len(text1), len(text2))):
+            if text1.endswith(text2[:length]) or text2.endswith(text1[:length]):
+                return True
+        return False
+
+    def makeAnyMatchRegex(self):
+        # If nothing matches at all, the text can be returned after a single search
+        patterns = []
+        for regex in self:
+            if regex.flags != re.UNICODE or re.search(r"\\[1-9]|\(\?P=", regex.pattern):
+                return
+            patterns.append("(?:" + regex.pattern + ")")
+        try:
+            return re.compile("|".join(patterns))
+        except re.error:
+            return
+
+
 class BaseTraffic(object):
-    alterationVariables = OrderedDict()
+    alterationVariables = AlterationSet()
+    idMapping = None
     def __init__(self, text, rcHandler=None, timestamp=None):
         self.text = text
         self.timestamp = timestamp
-        self.alterations = {}
+        self.alterations = AlterationSet()
         if rcHandler:
             self.diag = rcHandler.diag
-            for alterStr in rcHandler.getList("alterations", self.getAlterationSectionNames()):
-                toFind = os.path.expandvars(rcHandler.get("match_pattern", [ alterStr ]))
-                toReplace = rcHandler.getWithAddress("replacement", [ alterStr ])
-                if toFind and toReplace is not None:
-                    self.alterations[re.compile(toFind)] = toReplace
+            self.alterations = rcHandler.getAlterations(self.getAlterationSectionNames())
+            self.idMapping = rcHandler.idMapping
         
     @classmethod
     def get_timestamp(cls, rcHandler):                
@@ -35,26 +157,16 @@ class BaseTraffic(object):
         return False
 
     def applyAlterations(self, text):
+        if self.idMapping:
+            text = self.idMapping.apply(text, self.getAlterationSectionNames())
         return self._applyAlterations(text, self.alterations)
 
     def applyAlterationVariables(self, text):
         return self._applyAlterations(text, self.alterationVariables)
 
     def _applyAlterations(self, text, alterations):
-        class AlterationReplacer:
-            def __init__(rself, repl): #@NoSelf
-                rself.repl = repl
-
-            def __call__(rself, match): #@NoSelf
-                if rself.repl.startswith("$"):
-                    return self.storeAlterationVariable(rself.repl, match.group(0))
-                else:
-                    return match.expand(rself.repl)
-
-        # Reverse it for the alteration variables, we may add newer ones as we go along, want to check those first...
-        for regex, repl in reversed(list(alterations.items())):
-            text = regex.sub(AlterationReplacer(repl), text)
-        return text
+        # Applied in reverse for the alteration variables, we may add newer ones as we go along, want to check those first...
+        return alterations.apply(text, self.storeAlterationVariable)
 
     @staticmethod
     def findNextNameCandidate(name):